@@ -0,0 +1,76 @@
+""" Generates many maps in parallel, one solver per process, the ruleset is
+compiled once and sent to each worker process when it starts """
+import argparse
+import multiprocessing
+import os
+import time
+
+import wfc
+
+# Set once per worker process by init_worker
+worker_ruleset = None
+worker_backtracking = False
+
+
+def init_worker(ruleset, backtracking):
+    global worker_ruleset, worker_backtracking
+    worker_ruleset = ruleset
+    worker_backtracking = backtracking
+
+
+def solve_job(job):
+    """ Solves one (seed, size) job in a worker process """
+    seed, size = job
+    start = time.perf_counter()
+    solver = wfc.Solver(worker_ruleset, size, seed, backtracking=worker_backtracking)
+    grid = solver.solve()
+    return {
+        "seed": seed,
+        "solved_seed": solver.seed,
+        "size": tuple(size),
+        "grid": grid,
+        "overrides": solver.stats.overrides_count,
+        "contradictions": solver.stats.contradictions_count,
+        "impossible_positions": solver.get_impossible_positions_count(),
+        "time": time.perf_counter() - start,
+    }
+
+
+def solve_batch(ruleset, jobs, processes=None, backtracking=False):
+    """ Solves the (seed, size) jobs in a process pool, and yields each result
+    as soon as it is done (so not necessarily in the jobs order) """
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(ruleset, backtracking)) as pool:
+        for result in pool.imap_unordered(solve_job, jobs):
+            yield result
+
+
+def parse_size(size):
+    """ "10x20x10" -> (10, 20, 10) """
+    return tuple(int(axis) for axis in size.split("x"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solve maps for several seeds and sizes in parallel")
+    parser.add_argument("modules", help="modules json, e.g. win_tubes.json")
+    parser.add_argument("--seeds", type=int, nargs="+", required=True)
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=[(10, 10, 10)], help="e.g. 10x10x10 20x20x10")
+    parser.add_argument("--processes", type=int, default=None, help="defaults to the number of cores")
+    parser.add_argument("--backtracking", action="store_true")
+    parser.add_argument("--output-dir", help="save each solved grid of module indices in this directory, see wfc.save_map")
+    args = parser.parse_args()
+
+    ruleset = wfc.Ruleset.from_json(args.modules)
+    jobs = [(seed, size) for size in args.sizes for seed in args.seeds]
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    start = time.perf_counter()
+    for result in solve_batch(ruleset, jobs, args.processes, args.backtracking):
+        size = "x".join(str(axis) for axis in result["size"])
+        print(
+            f"seed {result['seed']:<6} {size:<12} {result['time']:.2f}s, "
+            f"{result['overrides']} overrides, {result['contradictions']} contradictions, "
+            f"{result['impossible_positions']} impossible positions"
+        )
+        if args.output_dir:
+            wfc.save_map(os.path.join(args.output_dir, f"map_{result['seed']}_{size}.npy"), result["grid"], ruleset)
+    print(f"{len(jobs)} maps in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,109 @@
+""" Reproducible solver benchmark: solves the tilesets on growing cubic grids
+with fixed seeds, and writes the measurements to a json file which can be
+compared with the one of a previous version """
+import argparse
+import datetime
+import json
+import os
+import platform
+import time
+import tracemalloc
+import numpy as np
+
+import wfc
+
+TILESETS = ["win_tubes.json", "path.json"]
+SIZES = [10, 25, 50, 100]
+SEEDS = [1, 2, 3]
+
+
+def run(ruleset, size, seed, backtracking=False, measure_memory=True):
+    """ Solves one map and returns its measurements. tracemalloc slows down
+    every allocation, so the peak memory is measured on a second solve """
+    start = time.perf_counter()
+    solver = wfc.Solver(ruleset, (size, size, size), seed, backtracking=backtracking)
+    collapses_count = 0
+    while solver.step():
+        collapses_count += 1
+    duration = time.perf_counter() - start
+    peak_memory = None
+    if measure_memory:
+        tracemalloc.start()
+        wfc.Solver(ruleset, (size, size, size), seed, backtracking=backtracking).solve()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        "seed": seed,
+        "time": duration,
+        "collapses": collapses_count,
+        "collapses_per_second": collapses_count / duration,
+        "propagation_steps": solver.stats.propagation_visited_cells,
+        "removed_modules": solver.stats.propagation_removed_modules,
+        "peak_memory": peak_memory,
+        "contradictions": solver.stats.contradictions_count,
+        "impossible_positions": solver.get_impossible_positions_count(),
+    }
+
+
+def benchmark(tilesets, sizes, seeds, backtracking=False, measure_memory=True):
+    results = []
+    for tileset in tilesets:
+        ruleset = wfc.Ruleset.from_json(tileset)
+        for size in sizes:
+            runs = [run(ruleset, size, seed, backtracking, measure_memory) for seed in seeds]
+            result = {
+                "tileset": os.path.basename(tileset),
+                "modules": len(ruleset),
+                "size": size,
+                "runs": runs,
+                "collapses_per_second": float(np.median([r["collapses_per_second"] for r in runs])),
+                "propagation_steps": float(np.median([r["propagation_steps"] for r in runs])),
+                "peak_memory": max(r["peak_memory"] or 0 for r in runs),
+                # Share of the runs which hit at least one contradiction
+                "contradiction_rate": sum(r["contradictions"] > 0 for r in runs) / len(runs),
+            }
+            results.append(result)
+            print(
+                f"{result['tileset']:<16} {size:>4}^3: {result['collapses_per_second']:10.1f} collapses/s, "
+                f"{result['propagation_steps']:10.0f} propagation steps, "
+                f"{result['peak_memory'] / 2**20:8.1f} MiB peak, "
+                f"{result['contradiction_rate'] * 100:5.1f}% contradicted runs"
+            )
+    return results
+
+
+def compare(results, previous_results):
+    """ Prints the throughput change against a previous benchmark """
+    previous = {(r["tileset"], r["size"]): r for r in previous_results}
+    for result in results:
+        before = previous.get((result["tileset"], result["size"]))
+        if before is None:
+            continue
+        ratio = result["collapses_per_second"] / before["collapses_per_second"]
+        print(f"{result['tileset']:<16} {result['size']:>4}^3: {ratio:.2f}x collapses/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the solver throughput")
+    parser.add_argument("--tilesets", nargs="+", default=[os.path.join(os.path.dirname(os.path.abspath(__file__)), tileset) for tileset in TILESETS])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="edge of the cubic grids")
+    parser.add_argument("--seeds", type=int, nargs="+", default=SEEDS)
+    parser.add_argument("--backtracking", action="store_true")
+    parser.add_argument("--skip-memory", action="store_true", help="don't solve each map a second time to measure the peak memory")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="previous benchmark json to compare with")
+    args = parser.parse_args()
+
+    results = benchmark(args.tilesets, args.sizes, args.seeds, args.backtracking, not args.skip_memory)
+    with open(args.output, "w") as f:
+        json.dump({
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "backtracking": args.backtracking,
+            "results": results,
+        }, f, indent=4)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f)["results"])
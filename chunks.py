@@ -0,0 +1,154 @@
+""" Generates worlds too large for a single wave, chunk by chunk. Each chunk
+is solved on its own, constrained by the faces of the already solved chunks
+next to it, so only one chunk sized wave is in memory per process.
+Chunks are solved by diagonal fronts (chunks whose x + y + z chunk indices
+are equal), the chunks of a front don't touch each other so they can be solved
+in parallel """
+import argparse
+import itertools
+import multiprocessing
+import random
+import time
+import numpy as np
+
+import batch
+import wfc
+
+
+def solve_chunk(ruleset, size, seed, neighbor_layers, border, border_module=wfc.EMPTY_MODULE_NAME, backtracking=False):
+    """ Solves a single chunk and returns its grid of module indices.
+    - neighbor_layers: {direction: 2D grid of module indices} for each known
+    layer of cells touching this chunk in this direction (solved neighbor
+    chunks, world border)
+    - border: boolean array of the chunk's size, True for the cells on the
+    outer shell of the world, filled with the border module """
+    allowed = np.ones(tuple(size) + (len(ruleset),), dtype=bool)
+    for direction, layer in neighbor_layers.items():
+        # Cells of this chunk facing the neighbor chunk
+        face = [slice(None)] * 3
+        axis = 2 - direction % 3
+        face[axis] = -1 if direction < 3 else 0
+        # Modules allowed next to the neighbor module, -1 (impossible cells
+        # in the neighbor) doesn't constrain anything
+        face_allowed = ruleset.adjacency[wfc.get_opposite_direction(direction)][layer]
+        face_allowed[layer < 0] = True
+        allowed[tuple(face)] &= face_allowed
+    if border.any():
+        allowed[border] = False
+        allowed[border, ruleset.indices[border_module]] = True
+    # Given as constraints, so restarts keep them
+    solver = wfc.Solver(ruleset, size, seed, border_module=None, backtracking=backtracking, constraints=allowed)
+    return solver.solve(), solver.stats.contradictions_count
+
+
+def solve_chunk_job(job):
+    """ Solves one chunk in a worker process, see batch.init_worker """
+    origin, size, seed, neighbor_layers, border, border_module = job
+    grid, contradictions_count = solve_chunk(
+        batch.worker_ruleset, size, seed, neighbor_layers, border, border_module, batch.worker_backtracking
+    )
+    return origin, grid, contradictions_count
+
+
+def get_chunk_seed(seed, chunk_index):
+    """ Each chunk has its own seed, derived from the world seed """
+    return random.Random(f"{seed}/{chunk_index}").randrange(2**32)
+
+
+def solve_chunked(ruleset, world_size, chunk_size, seed=None, processes=1, backtracking=False,
+                  border_module=wfc.EMPTY_MODULE_NAME, output=None):
+    """ Solves the world chunk by chunk and returns its grid of module indices.
+    If output is given, the grid is a .npy file memory mapped there instead
+    of an array held in memory, with its name table, see wfc.save_map """
+    if seed is None:
+        seed = random.randrange(2**32)
+    if output:
+        world = np.lib.format.open_memmap(output, mode="w+", dtype=wfc.MAP_DTYPE, shape=tuple(world_size))
+        wfc.write_name_table(output, ruleset)
+    else:
+        world = np.empty(world_size, dtype=wfc.MAP_DTYPE)
+    world[...] = -1
+    chunks_count = [-(-world_axis // chunk_axis) for world_axis, chunk_axis in zip(world_size, chunk_size)]
+    contradictions_count = 0
+
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes, initializer=batch.init_worker, initargs=(ruleset, backtracking))
+    try:
+        for front in range(sum(chunks_count) - 2):
+            jobs = []
+            for chunk_index in itertools.product(*[range(count) for count in chunks_count]):
+                if sum(chunk_index) == front:
+                    jobs.append(get_chunk_job(ruleset, world, chunk_index, chunk_size, seed, border_module))
+            if pool is None:
+                results = [
+                    (job[0],) + solve_chunk(ruleset, *job[1:], backtracking=backtracking)
+                    for job in jobs
+                ]
+            else:
+                results = pool.map(solve_chunk_job, jobs)
+            for origin, grid, chunk_contradictions_count in results:
+                world[tuple(slice(start, start + axis) for start, axis in zip(origin, grid.shape))] = grid
+                contradictions_count += chunk_contradictions_count
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if output:
+        world.flush()
+    return world, contradictions_count
+
+
+def get_chunk_job(ruleset, world, chunk_index, chunk_size, seed, border_module):
+    """ Returns everything a worker needs to solve the chunk: its origin and
+    size in the world, its seed, the known layers touching it and the world
+    border cells it contains """
+    origin = tuple(index * axis for index, axis in zip(chunk_index, chunk_size))
+    size = tuple(min(axis, world_axis - start) for axis, world_axis, start in zip(chunk_size, world.shape, origin))
+    chunk = tuple(slice(start, start + axis) for start, axis in zip(origin, size))
+    neighbor_layers = {}
+    # Chunks before this one on each axis are already solved (previous front):
+    # left (-x), front (-y), bottom (-z)
+    for direction in [5, 4, 3]:
+        axis = 2 - direction % 3
+        if origin[axis] == 0:
+            continue
+        layer = list(chunk)
+        layer[axis] = origin[axis] - 1
+        neighbor_layers[direction] = np.array(world[tuple(layer)])
+    border = np.zeros(size, dtype=bool)
+    if border_module is not None:
+        # The chunks after this one aren't solved yet, but if they start with
+        # the world border its cells are already known: right, back, top
+        for direction in [2, 1, 0]:
+            axis = 2 - direction % 3
+            if origin[axis] + size[axis] == world.shape[axis] - 1:
+                layer_shape = [axis_size for i, axis_size in enumerate(size) if i != axis]
+                neighbor_layers[direction] = np.full(layer_shape, ruleset.indices[border_module], dtype=np.int32)
+        # Cells on the first or last layer of the world on any axis
+        for axis, (start, axis_size, world_axis) in enumerate(zip(origin, size, world.shape)):
+            coordinates = np.arange(start, start + axis_size)
+            on_border = (coordinates == 0) | (coordinates == world_axis - 1)
+            border |= on_border.reshape([-1 if i == axis else 1 for i in range(3)])
+    return origin, size, get_chunk_seed(seed, chunk_index), neighbor_layers, border, border_module
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solve a large world chunk by chunk")
+    parser.add_argument("modules", help="modules json, e.g. win_tubes.json")
+    parser.add_argument("--size", type=int, nargs=3, required=True, metavar=("X", "Y", "Z"))
+    parser.add_argument("--chunk-size", type=int, nargs=3, default=[16, 16, 16], metavar=("X", "Y", "Z"))
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--processes", type=int, default=1, help="0 for one per core")
+    parser.add_argument("--backtracking", action="store_true")
+    parser.add_argument("--output", help="write the world's grid of module indices to this .npy file while solving")
+    args = parser.parse_args()
+
+    ruleset = wfc.Ruleset.from_json(args.modules)
+    start = time.perf_counter()
+    world, contradictions_count = solve_chunked(
+        ruleset, args.size, args.chunk_size, args.seed, args.processes or None,
+        args.backtracking, output=args.output
+    )
+    print(f"{world.size} cells in {time.perf_counter() - start:.2f}s")
+    print(f"{contradictions_count} contradictions, {np.count_nonzero(world < 0)} impossible positions")
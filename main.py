@@ -1,33 +1,61 @@
 import bpy
-import json
+import hashlib
+import importlib
 import math
+import os
 import random
+import sys
+import time
+import numpy as np
+from mathutils import Matrix
 from pprint import pprint
 
+# Blender doesn't add the script directory to the path, the headless solver
+# lives next to this file (or next to the .blend when run from the text editor)
+for path in [os.path.dirname(os.path.abspath(__file__)), bpy.path.abspath("//")]:
+    if path and path not in sys.path:
+        sys.path.append(path)
+import wfc
+# Blender keeps imported modules between script runs
+importlib.reload(wfc)
+from wfc import ROTATIONS
+
 X_GRID_SIZE = 10
 Y_GRID_SIZE = 10
 Z_GRID_SIZE = 10
 EMPTY_SLOTS_NBR = int((X_GRID_SIZE * Y_GRID_SIZE * Z_GRID_SIZE) / 1.1)
 EMPTY_SLOTS_NBR = 0
-MAX_CONSECUTIVE_OVERRIDES = 5
+# (cell, modules) pairs applied before solving, e.g. ((1, 1, 1), ["Start"]) for
+# a start piece in any rotation, or a box forbidden to anything but empty:
+# ((slice(2, 5), slice(2, 5), slice(1, 4)), ["Empty_0"]), see wfc.Solver
+PINNED_CELLS = []
 CHOSEN_TICK_LENGTH = 1
 COLLAPSED_TICK_LENGTH = 0
 DEFAULT_POSITION = (0, 0, 100)
 ASSIGN_MATERIAL = False
 DRAW_EMPTIES = False
 SEED = 79
+# Undo contradictions (and restart with a new seed if needed) instead of
+# leaving impossible cells, see wfc.MAX_BACKTRACK_DEPTH and friends
+BACKTRACKING = False
 ANIMATION_LENGTH = 500
 ANIMATE = True
+# "objects": one linked duplicate per cell, animated if ANIMATE
+# "merged": all the cells in a single mesh built at the end (no animation),
+# much faster on large maps
+OUTPUT_MODE = "objects"
 
 JSON_MODULES_DATA_PATH = "/home/zodiac/Code/Perso/Trackmania-WFC/win_tubes.json"
-CELLS_MODIFICATIONS_HISTORY_PATH = "/home/zodiac/Code/Perso/Trackmania-WFC/output.txt"
-ROTATIONS = [
-"", "X", "Y", "Z", "XX", "XY", "XZ", "YX", "YY", "ZY", "ZZ", "XXX", "XXY",
-"XXZ", "XYX", "XYY", "XZZ", "YXX", "YYY", "ZZZ", "XXXY", "XXYX", "XYXX", "XYYY"
-]
-# ROTATIONS = [
-# "", "Z", "ZZ", "ZZZ"
-# ]
+# Binary trace of every cell set during the solve (see wfc.read_trace), None to disable
+TRACE_PATH = None
+# Save the solved grid of module indices to this .npy file (see wfc.save_map), None to disable
+MAP_PATH = None
+# Solve in a modal operator instead of freezing Blender until the map is done:
+# the solver runs for ASYNC_TIME_SLICE seconds every ASYNC_UPDATE_INTERVAL
+# seconds, the viewport shows the cells placed so far, ESC cancels
+ASYNC_SOLVE = False
+ASYNC_TIME_SLICE = 0.1
+ASYNC_UPDATE_INTERVAL = 0.01
 
 class App(object):
     def __init__(self):
@@ -37,18 +65,59 @@ class App(object):
             self.seed = random.randint(0, 100)
         else:
             self.seed = SEED
-        random.seed(self.seed)
+
+        # Creates a collection in which all created blocks will go
+        create_blender_collection("Output")
+        self.tick = 10  # Start offset for blender animation
+        # Blender object of each cell, to replace it when its region is solved again
+        self.cell_objects = {}
+        # (object name, position) of each cell, for the "merged" output mode
+        self.placements = {}
+        # (object, position, tick) of each object placed during the solve,
+        # animated all at once afterwards, see animate_objects
+        self.animations = []
+        self.merged_object = None
 
         self.handle_modules_creation()
         self.handle_map_creation()
 
-        # Creates a collection in which all created blocks will go
-        create_blender_collection("Output")
         # self.display_map()
         # Perform WFC on the map
-        self.tick = 10  # Start offset for blender animation
-        self.waveshift_function_collapse()
+        self.run_solver()
+
+    def resolve_region(self, start, end):
+        """ Generates again the cells of the box between start (included) and
+        end (excluded), keeping the rest of the map and its Blender objects """
+        if self.trace is not None:
+            # Closed once the previous solve was done, see log
+            self.trace = self.solver.trace = wfc.Trace(TRACE_PATH, append=True)
+        self.solver.reset_region(start, end)
+        self.run_solver()
+
+    def run_solver(self):
+        if ASYNC_SOLVE:
+            # The operator calls finish_collapse once done or cancelled
+            WFC_OT_solve.app = self
+            bpy.ops.wfc.solve("INVOKE_DEFAULT")
+        else:
+            self.waveshift_function_collapse()
+            self.finish_collapse()
+
+    def finish_collapse(self):
+        """ Builds what needs the whole map once the solver is done """
+        if ANIMATE:
+            animate_objects(self.animations)
+            self.animations = []
+        if OUTPUT_MODE == "merged":
+            if self.merged_object is not None:
+                # A single mesh for the whole map, so it is built again
+                mesh = self.merged_object.data
+                bpy.data.objects.remove(self.merged_object, do_unlink=True)
+                bpy.data.meshes.remove(mesh)
+            self.merged_object = create_merged_object("Output", self.placements.values())
         bpy.data.scenes["Scene"].frame_end = self.tick + 10
+        if MAP_PATH:
+            wfc.save_map(MAP_PATH, self.solver.get_grid(), self.ruleset)
         self.log()
 
     def handle_modules_creation(self):
@@ -57,56 +126,34 @@ class App(object):
         # will go during modules data loading
         create_blender_collection("Generated modules")
         # Load all the modules data from the json
+        self.ruleset = wfc.Ruleset.from_json(JSON_MODULES_DATA_PATH)
         self.modules = {}
-        self.socket_types_count = 0
-        self.load_modules_data(JSON_MODULES_DATA_PATH)
-        self.create_links()
+        # Same modules, addressed by their index in the ruleset
+        self.modules_list = []
+        self.create_modules()
         vlayer = bpy.context.scene.view_layers['View Layer']
         vlayer.layer_collection.children['Generated modules'].hide_viewport = True
 
-        # Modules data recording
-        self.last_chosen_module = None
-        self.overrides_count = 0
-        self.consecutive_overrides_count = 0
-        self.impossible_positions_count = 0
-        self.original_modules_count = {}
-        for module_name, module in self.modules.items():
-            self.original_modules_count[module.original_scene_object_name] = 0
-
     def handle_map_creation(self):
-        # Initialize map
-        self.map = []
-        self.cells_modifications_history = {}
-        for x in range(X_GRID_SIZE):
-            tmpY = []
-            for y in range(Y_GRID_SIZE):
-                tmpZ = []
-                for z in range(Z_GRID_SIZE):
-                    # To keep a log of all cells modifications
-                    self.cells_modifications_history[Vector3(x, y, z).__repr__()] = []
-                    # Add one single cell, z times
-                    if x == 0 or y == 0 or z == 0 or x == (X_GRID_SIZE -1) or y == (Y_GRID_SIZE -1) or z == (Z_GRID_SIZE -1):
-                        print("empty to", Vector3(x, y, z))
-                        tmpZ.append(set([self.modules["Empty_0"]]))
-                    else:
-                        tmpZ.append(set([m for m in self.modules.values()]))
-                # Add one single line, y times
-                tmpY.append(tmpZ)
-            # Add one single plane, x times
-            self.map.append(tmpY)
-
-
-
-        for x in range(X_GRID_SIZE):
-            for y in range(Y_GRID_SIZE):
-                for z in range(Z_GRID_SIZE):
-                    if x == 0 or y == 0 or z == 0 or x == (X_GRID_SIZE -1) or y == (Y_GRID_SIZE -1) or z == (Z_GRID_SIZE -1):
-                        # print("Updating", Vector3(x, y, z))
-                        self.update_possibilities(Vector3(x, y, z), 20)
-
-
-        # for i in range(EMPTY_SLOTS_NBR):
-        #     self.map[random.randint(0, X_GRID_SIZE -1)][random.randint(0, Y_GRID_SIZE -1)][random.randint(0, Z_GRID_SIZE -1)] = set([self.modules["Empty_0"]])
+        # To keep a log of all cells modifications
+        self.trace = wfc.Trace(TRACE_PATH) if TRACE_PATH else None
+        constraints = list(PINNED_CELLS)
+        # Random empty cells, the same ones for a given seed
+        empty_slots_random = random.Random(self.seed)
+        for i in range(EMPTY_SLOTS_NBR):
+            cell = tuple(empty_slots_random.randrange(axis) for axis in (X_GRID_SIZE, Y_GRID_SIZE, Z_GRID_SIZE))
+            constraints.append((cell, [wfc.EMPTY_MODULE_NAME]))
+        # The solver fills the outer shell of the map with Empty_0
+        self.solver = wfc.Solver(
+            self.ruleset, (X_GRID_SIZE, Y_GRID_SIZE, Z_GRID_SIZE), self.seed,
+            strategy="override", border_module=wfc.EMPTY_MODULE_NAME,
+            on_cell_set=self.place_cell, backtracking=BACKTRACKING, trace=self.trace,
+            on_progress=self.print_progress, on_cell_unset=self.unplace_cell,
+            constraints=constraints
+        )
+
+    def print_progress(self, stats):
+        print(f"{stats.progress * 100:.1f}% ({stats.collapses_count} collapses)")
 
     def log(self):
         # Logging
@@ -114,231 +161,94 @@ class App(object):
         # pprint(list(self.modules.values()))
         print('-'*80)
         print("Seed:", self.seed)
-        print(f"{len(self.modules)} modules, {self.socket_types_count + 1} socket types")
-        print(f"{self.overrides_count} overrides")
+        if self.solver.seed != self.seed:
+            print("Restarted with seed:", self.solver.seed)
+        print(f"{len(self.modules)} modules ({sum(self.ruleset.variants_count)} rotations before merging the symmetric ones), {self.ruleset.socket_types_count + 1} socket types")
+        # Counters and time spent in each phase, "output" is the time spent
+        # creating the Blender objects
+        print(self.solver.stats)
         print(f"{EMPTY_SLOTS_NBR} filled with Empty objects")
-        self.get_impossible_positions_count()
-        print(f"{(self.impossible_positions_count/(X_GRID_SIZE * Y_GRID_SIZE * Z_GRID_SIZE) * 100):.2f}% ({self.impossible_positions_count}/{X_GRID_SIZE * Y_GRID_SIZE * Z_GRID_SIZE}) impossible positions")
-        # Write cell modifications history to a text file
-        with open(CELLS_MODIFICATIONS_HISTORY_PATH, 'w') as f:
-            for cell_pos, modifications in self.cells_modifications_history.items():
-                f.write(f"{cell_pos}\n")
-                for modification in modifications:
-                    f.write(f"\t{modification}\n")
+        impossible_positions_count = self.solver.get_impossible_positions_count()
+        print(f"{(impossible_positions_count/(X_GRID_SIZE * Y_GRID_SIZE * Z_GRID_SIZE) * 100):.2f}% ({impossible_positions_count}/{X_GRID_SIZE * Y_GRID_SIZE * Z_GRID_SIZE}) impossible positions")
+        if self.trace is not None:
+            # Not left open in Blender between runs, resolve_region appends to it
+            self.trace.close()
+            print("Trace written to", TRACE_PATH)
 
 
 #########################################
 # Utility functions
-    def load_modules_data(self, filepath):
-        with open(filepath, "r") as f:
-            modules_data = json.load(f)
-
-        x_pos = 0
-        # Create all modules
-        for module in modules_data:
-            # Only needed to get total socket_types_count
-            for directions in module["sockets"]:
-                for socket_type in directions:
-                    if socket_type > self.socket_types_count:
-                        self.socket_types_count = socket_type
-            y_pos = 0
-            # Create all the rotated meshes
-            if module["rotations"][0] == -1:
-                module["rotations"] = [idx for idx in range(len(ROTATIONS))]
-            for rotation in module["rotations"]:
-                name = f"""{module["module_name"]}_{rotation}"""
-                self.modules[name] = Module(name, module, rotation, Vector3(x_pos, y_pos, 0))
-                y_pos += 1
-            x_pos += 1
-
-    def create_links(self):
-        # For each module
-        for a_name, a_module in self.modules.items():
-            # For each direction
-            for direction, matching_cell_socket_types in enumerate(a_module.sockets):
-                # For each matching socket type (each direction can have multiple socket types)
-                for a_socket_type in matching_cell_socket_types:
-                    # Add all matching sockets
-                    for b_name, b_module in self.modules.items():
-                        b_socket_types = b_module.sockets[self.get_opposite_direction(direction)]
-                        if a_socket_type in b_socket_types:
-                            self.create_link(a_module, direction, b_module)
-
-    def create_link(self, nodeA, direction, nodeB):
-        nodeA.create_link(nodeB, direction)
-        direction = self.get_opposite_direction(direction)
-        nodeB.create_link(nodeA, direction)
-
-    def get_opposite_direction(self, dir): #perhaps here
-        return (dir + 3) % 6
-
-    def choose_module_from_possibilities(self, cell, possible_modules, type="override"):
-        if type == "lowest":
-            res = []
-            lowest = X_GRID_SIZE * Y_GRID_SIZE * Z_GRID_SIZE
-            for module in possible_modules:
-                if self.original_modules_count[module.original_scene_object_name] < lowest:
-                    lowest = self.original_modules_count[module.original_scene_object_name]
-                    res = [module]
-                elif self.original_modules_count[module.original_scene_object_name] == lowest:
-                    res.append(module)
-        elif type == "override":
-            res = list(possible_modules)
-            if self.last_chosen_module and self.last_chosen_module in possible_modules:
-                # print(self.last_chosen_module.self_attraction)
-                if self.last_chosen_module.self_attraction:
-                    self.overrides_count += 1
-                    self.consecutive_overrides_count += 1
-                    if self.consecutive_overrides_count < MAX_CONSECUTIVE_OVERRIDES:
-                        return self.last_chosen_module
-            self.consecutive_overrides_count = 0
-        elif type == "random":
-            res = list(possible_modules)
-        elif type == "empty":
-            res = list(possible_modules)
-            if self.modules["Empty_0"] in possible_modules and random.randint(0, 2) != 0:
-                return self.modules["Empty_0"]
-        return random.choice(res)
+    def create_modules(self):
+        """ Creates the rotated Blender object of each module of the ruleset """
+        scene_objects_x_pos = {}
+        y_pos = 0
+        # Hash of each original mesh, see get_rotated_mesh
+        mesh_hashes = {}
+        for index, name in enumerate(self.ruleset.names):
+            # One column per original object, one row per rotation
+            scene_object_name = self.ruleset.scene_object_names[index]
+            if scene_object_name not in scene_objects_x_pos:
+                scene_objects_x_pos[scene_object_name] = len(scene_objects_x_pos)
+                y_pos = 0
+            x_pos = scene_objects_x_pos[scene_object_name]
+            self.modules[name] = Module(name, index, self.ruleset, Vector3(x_pos, y_pos, 0), mesh_hashes)
+            self.modules_list.append(self.modules[name])
+            y_pos += 1
+        # Rotated meshes kept from previous runs whose module or rotation is
+        # not in the ruleset anymore, only held by their fake user
+        bpy.data.batch_remove([
+            mesh for mesh in bpy.data.meshes
+            if "wfc_source_hash" in mesh and mesh.use_fake_user and mesh.users == 1
+        ])
 
 
 #########################################
 # WFC algorithm functions
     def waveshift_function_collapse(self):
-        while 1:
-            # Get the next cell to update
-            cell = self.get_minimal_entropy_cell()
-            if cell is None:
-                break
-            module = self.choose_module_from_possibilities(
-                cell, self.map[cell.x][cell.y][cell.z], "override"
-            )
-            self.set_cell(cell, module)
-            # Now propagate to neighbors
-            self.update_possibilities(cell, 20)
+        self.solver.solve()
 
-    def set_cell(self, cell, module):
-        self.last_chosen_module = module  # For override
-        # For minimal module count choice
+    def place_cell(self, cell, module_index, chosen):
+        """ Called by the solver each time a cell gets its final module """
+        module = self.modules_list[module_index]
         module.count += 1
-        self.original_modules_count[module.original_scene_object_name] += 1
-        # For logging
-        self.cells_modifications_history[cell.__repr__()].append(f"Assigned {module} from {self.map[cell.x][cell.y][cell.z]} possible modules")
-        # Assign cell
-        self.map[cell.x][cell.y][cell.z] = {module}
+        position = Vector3(*cell)
+        if OUTPUT_MODE == "merged":
+            # Blender is only updated once the whole map is solved
+            self.placements[cell] = (module.name, position)
         # Update Blender
-        duplicate_and_place_object(module.name, cell, "chosen", self.tick)
-        self.tick += CHOSEN_TICK_LENGTH
-
-    def update_possibilities(self, cell, depth):
-        # End of recursion conditions
-        # if depth == 0:
-        #     return
-        to_be_updated_neighbors = set()
-        # Top
-        neighbor = Vector3(cell.x, cell.y, cell.z + 1)
-        if cell.z < Z_GRID_SIZE - 1 and len(self.map[neighbor.x][neighbor.y][neighbor.z]) > 1:
-            to_be_updated_neighbors.update(self.update_neighbor(cell, neighbor, 0))
-        # Bottom
-        neighbor = Vector3(cell.x, cell.y, cell.z - 1)
-        if cell.z > 0 and len(self.map[neighbor.x][neighbor.y][neighbor.z]) > 1:
-            to_be_updated_neighbors.update(self.update_neighbor(cell, neighbor, 3))
-        # Front
-        neighbor = Vector3(cell.x, cell.y - 1, cell.z)
-        if cell.y > 0 and len(self.map[neighbor.x][neighbor.y][neighbor.z]) > 1:
-            to_be_updated_neighbors.update(self.update_neighbor(cell, neighbor, 4))
-        # Back
-        neighbor = Vector3(cell.x, cell.y + 1, cell.z)
-        if cell.y < Y_GRID_SIZE - 1 and len(self.map[neighbor.x][neighbor.y][neighbor.z]) > 1:
-            to_be_updated_neighbors.update(self.update_neighbor(cell, neighbor, 1))
-        # Left
-        neighbor = Vector3(cell.x - 1, cell.y, cell.z)
-        if cell.x > 0 and len(self.map[neighbor.x][neighbor.y][neighbor.z]) > 1:
-            to_be_updated_neighbors.update(self.update_neighbor(cell, neighbor, 5))
-        # Right
-        neighbor = Vector3(cell.x + 1, cell.y, cell.z)
-        if cell.x < X_GRID_SIZE - 1 and len(self.map[neighbor.x][neighbor.y][neighbor.z]) > 1:
-            to_be_updated_neighbors.update(self.update_neighbor(cell, neighbor, 2))
-
-        # Propagate the collapse to neighbor which had changes
-        for neighbor in to_be_updated_neighbors:
-            self.update_possibilities(neighbor, depth - 1)
-
-    def update_neighbor(self, cell, neighbor, direction):
-        out = set()
-        a_possible_neighbors = set()
-        cell_states = self.map[cell.x][cell.y][cell.z]
-        # For each possible module of the cell
-        for cell_state in cell_states:
-            # Add the possibilities based on this direction
-            for possible_neighbor in cell_state.links[direction]:
-                a_possible_neighbors.add(possible_neighbor)
-        ########
-        # Remove impossible modules
-        tmp = set()
-        # For each possible module in the neighbor, remove impossible modules
-        for neighbor_state in self.map[neighbor.x][neighbor.y][neighbor.z]:
-            if neighbor_state in a_possible_neighbors:
-                    tmp.add(neighbor_state)
-        # Add the neighbor to the to-be-updated neighbors list if a change has been made
-        if set(self.map[neighbor.x][neighbor.y][neighbor.z]) != tmp:
-            # self.cells_modifications_history[neighbor.__repr__()].append(f"Updated to {tmp} from {self.map[neighbor.x][neighbor.y][neighbor.z]}, because of {cell} with modules {cell_states}")
-            self.map[neighbor.x][neighbor.y][neighbor.z] = tmp
-            if len(tmp) == 1:
-                self.cells_modifications_history[cell.__repr__()].append((self.tick, neighbor, False))
-                duplicate_and_place_object(tmp.pop().name, neighbor, "collapsed", self.tick)
-                self.tick += COLLAPSED_TICK_LENGTH
-
-            out.add(neighbor)
-        return out
-
-    def get_minimal_entropy_cell(self):
-        """ Returns the cell with the lowest entropy of all, if multiple cells
-        have the same entropy, choose one at random """
-        minimal_entropy = len(self.modules)
-        minimal_entropy_cells = []
-        tmp_count = 0
-        for x in range(X_GRID_SIZE):
-            for y in range(Y_GRID_SIZE):
-                for z in range(Z_GRID_SIZE):
-                    # Ignore already finished cells
-                    if len(self.map[x][y][z]) < 2:
-                        tmp_count += 1
-                        continue
-                    # Lower entropy found
-                    elif len(self.map[x][y][z]) < minimal_entropy:
-                        minimal_entropy = len(self.map[x][y][z])
-                        minimal_entropy_cells = [Vector3(x, y, z)]
-                    # Add to the list of lowest entropy cells
-                    elif len(self.map[x][y][z]) == minimal_entropy:
-                        minimal_entropy_cells.append(Vector3(x, y, z))
-
-        if len(minimal_entropy_cells) > 0:
-            # Choose a random minimum entropy cell
-            return random.choice(minimal_entropy_cells)
-        return None
+        if OUTPUT_MODE == "objects":
+            obj = duplicate_and_place_object(module.name, position, "chosen" if chosen else "collapsed")
+            if obj is not None:
+                self.cell_objects[cell] = obj
+                self.animations.append((obj, position, self.tick))
+        self.tick += CHOSEN_TICK_LENGTH if chosen else COLLAPSED_TICK_LENGTH
+
+    def unplace_cell(self, cell, module_index):
+        """ Called by the solver when a cell is reopened, see resolve_region """
+        self.modules_list[module_index].count -= 1
+        self.placements.pop(cell, None)
+        obj = self.cell_objects.pop(cell, None)
+        if obj is not None:
+            bpy.data.objects.remove(obj, do_unlink=True)
 
 #########################################
 # Blender functions
     def display_map(self):
+        grid = self.solver.get_grid()
+        animations = []
         for x in range(X_GRID_SIZE):
             for y in range(Y_GRID_SIZE):
                 for z in range(Z_GRID_SIZE):
                     pos = Vector3(x,y,z)
-                    states = self.map[x][y][z]
-                    states_count = len(states)
+                    states_count = self.solver.possibilities_count[x, y, z]
                     if states_count == 1:
-                        duplicate_and_place_object(states.pop().name, pos, "random", 0)
-                    elif states_count == 0:
-                        self.impossible_positions_count += 1
+                        obj = duplicate_and_place_object(self.modules_list[grid[x, y, z]].name, pos, "random")
+                        if obj is not None:
+                            animations.append((obj, pos, 0))
                     elif states_count > 1:
-                        print(f"ignored: {pos} due to cell not collapsed (states: {states})")
-
-    def get_impossible_positions_count(self):
-        for x in range(X_GRID_SIZE):
-            for y in range(Y_GRID_SIZE):
-                for z in range(Z_GRID_SIZE):
-                    if len(self.map[x][y][z]) == 0:
-                        self.impossible_positions_count += 1
+                        print(f"ignored: {pos} due to cell not collapsed (states: {states_count})")
+        if ANIMATE:
+            animate_objects(animations)
 
 ## Non part of the class
 def clean_blender_scene():
@@ -346,30 +256,24 @@ def clean_blender_scene():
     - The scene is supposed to have a "Modules" collection, which will be left
     untouched
     - All other collections will be deleted
-    - Purge orphan data
+    - Purge orphan data, except the rotated module meshes which have a fake
+    user to be reused by the next run (see get_rotated_mesh)
+    Everything is removed with batch_remove, much faster than one by one
     """
-    for collection in bpy.data.collections:
-        if collection.name not in ["Modules", "Scene", "Backups"]:
-            # Delete all the objects
-            for obj in collection.objects:
-                bpy.data.objects.remove(obj, do_unlink=True)
-            bpy.data.collections.remove(collection)
-    # Purge orphan data
-    for block in bpy.data.objects:
-        if block.users == 0:
-            bpy.data.objects.remove(block)
-    for block in bpy.data.meshes:
-        if block.users == 0:
-            bpy.data.meshes.remove(block)
-    for block in bpy.data.materials:
-        if block.users == 0:
-            bpy.data.materials.remove(block)
-    for block in bpy.data.textures:
-        if block.users == 0:
-            bpy.data.textures.remove(block)
-    for block in bpy.data.images:
-        if block.users == 0:
-            bpy.data.images.remove(block)
+    collections = [
+        collection for collection in bpy.data.collections
+        if collection.name not in ["Modules", "Scene", "Backups"]
+    ]
+    # Delete all the objects
+    objects = {obj for collection in collections for obj in collection.objects}
+    bpy.data.batch_remove(list(objects) + collections)
+    # Purge orphan data, objects first as they hold their meshes
+    bpy.data.batch_remove([block for block in bpy.data.objects if block.users == 0])
+    bpy.data.batch_remove([
+        block
+        for data in [bpy.data.meshes, bpy.data.materials, bpy.data.textures, bpy.data.images, bpy.data.actions]
+        for block in data if block.users == 0
+    ])
 
 
 def create_blender_collection(collection_name):
@@ -377,13 +281,14 @@ def create_blender_collection(collection_name):
     bpy.context.scene.collection.children.link(collection)
 
 
-def duplicate_and_place_object(object_name, position, material_name, tick, unlink=False):
+def duplicate_and_place_object(object_name, position, material_name, unlink=False):
     """ This function duplicates an object (but the underlying is kept the same)
-    so the two objects are linked, then positions the newly created object """
+    so the two objects are linked, then positions the newly created object,
+    and returns it """
     if not object_name:
-        return
+        return None
     if not DRAW_EMPTIES and bpy.data.objects[object_name].data is None:
-        return
+        return None
     if unlink:
         if bpy.data.objects[object_name].data is not None:
             new_obj = bpy.data.objects.new(
@@ -398,17 +303,8 @@ def duplicate_and_place_object(object_name, position, material_name, tick, unlin
     else:  # the new object is created with the old object's data, which makes it "linked"
         new_obj = bpy.data.objects.new(f"{object_name}_{position}", bpy.data.objects[object_name].data)
 
-    if ANIMATE:
-        # now it's just an object ref and you can move it to an absolute position
-        new_obj.location = (DEFAULT_POSITION[0], DEFAULT_POSITION[1], DEFAULT_POSITION[2])
-        new_obj.keyframe_insert(data_path='location', frame=tick - 1)
-        new_obj.location = (position.x * 2, position.y * 2, position.z * 2)
-        new_obj.keyframe_insert(data_path='location', frame=tick)
-        new_obj.keyframe_insert(data_path='location', frame=tick + ANIMATION_LENGTH)
-        new_obj.location = (DEFAULT_POSITION[0], DEFAULT_POSITION[1], DEFAULT_POSITION[2])
-        new_obj.keyframe_insert(data_path='location', frame=tick + ANIMATION_LENGTH + 1)
-    else:
-        new_obj.location = (position.x * 2, position.y * 2, position.z * 2)
+    # now it's just an object ref and you can move it to an absolute position
+    new_obj.location = (position.x * 2, position.y * 2, position.z * 2)
 
     # when you create a new object manually this way it's not part of any collection, add it to the active collection so you can actually see it in the viewport
     bpy.data.collections['Output'].objects.link(new_obj)
@@ -423,125 +319,223 @@ def duplicate_and_place_object(object_name, position, material_name, tick, unlin
         else:
             color = (0.2, 0.2, 0.2, 1.0)
         add_material(new_obj, material_name, color)
-
-
-def blender_rotate(ob, rotation):
-    ob.rotation_euler[0] = math.radians(rotation.x)
-    ob.rotation_euler[1] = math.radians(rotation.y)
-    ob.rotation_euler[2] = math.radians(rotation.z)
-    bpy.data.objects[ob.name].select_set(True)
-    bpy.ops.object.transform_apply(rotation=True)
-    bpy.data.objects[ob.name].select_set(False)
+    return new_obj
+
+
+def animate_objects(animations):
+    """ Animates each (object, position, tick): the object comes from
+    DEFAULT_POSITION at tick and goes back there ANIMATION_LENGTH later. The
+    same keys keyframe_insert would insert, but each F-curve is filled at once
+    with foreach_set instead of going through the data path for every key """
+    for obj, position, tick in animations:
+        location = (position.x * 2, position.y * 2, position.z * 2)
+        animation_data = obj.animation_data_create()
+        animation_data.action = bpy.data.actions.new(f"{obj.name}Action")
+        for index in range(3):
+            fcurve = animation_data.action.fcurves.new("location", index=index, action_group="Object Transforms")
+            fcurve.keyframe_points.add(4)
+            fcurve.keyframe_points.foreach_set("co", [
+                tick - 1, DEFAULT_POSITION[index],
+                tick, location[index],
+                tick + ANIMATION_LENGTH, location[index],
+                tick + ANIMATION_LENGTH + 1, DEFAULT_POSITION[index],
+            ])
+            # Computes the automatic handles of the new keys
+            fcurve.update()
+
+
+def create_merged_object(name, placements):
+    """ Creates a single object containing the meshes of all the (object name, position)
+    placements, the mesh is filled in bulk with foreach_set instead of creating
+    one object per cell """
+    vertices, loops, loop_starts, loop_totals, material_indices, smooth = [], [], [], [], [], []
+    # uvs of each placement, by uv layer name
+    placements_uvs = []
+    uv_layer_names = {}
+    vertices_count = 0
+    loops_count = 0
+    materials = []
+    # Mesh data of each module, only read once
+    meshes_data = {}
+    for object_name, position in placements:
+        mesh = bpy.data.objects[object_name].data
+        if mesh is None:  # Empty objects
+            continue
+        if object_name not in meshes_data:
+            meshes_data[object_name] = read_mesh_data(mesh, materials)
+        co, vertex_index, loop_start, loop_total, material_index, use_smooth, uvs = meshes_data[object_name]
+        vertices.append(co + (position.x * 2, position.y * 2, position.z * 2))
+        loops.append(vertex_index + vertices_count)
+        loop_starts.append(loop_start + loops_count)
+        loop_totals.append(loop_total)
+        material_indices.append(material_index)
+        smooth.append(use_smooth)
+        placements_uvs.append((uvs, len(vertex_index)))
+        uv_layer_names.update(dict.fromkeys(uvs))
+        vertices_count += len(co)
+        loops_count += len(vertex_index)
+
+    mesh = bpy.data.meshes.new(name)
+    if vertices:
+        mesh.vertices.add(vertices_count)
+        mesh.vertices.foreach_set("co", np.concatenate(vertices).ravel())
+        mesh.loops.add(loops_count)
+        mesh.loops.foreach_set("vertex_index", np.concatenate(loops))
+        mesh.polygons.add(sum(len(loop_start) for loop_start in loop_starts))
+        mesh.polygons.foreach_set("loop_start", np.concatenate(loop_starts))
+        if bpy.app.version < (4, 0, 0):  # Computed from loop_start since 4.0
+            mesh.polygons.foreach_set("loop_total", np.concatenate(loop_totals))
+        mesh.polygons.foreach_set("material_index", np.concatenate(material_indices))
+        mesh.polygons.foreach_set("use_smooth", np.concatenate(smooth))
+        # Modules without a layer get (0, 0) uvs on it
+        for uv_layer_name in uv_layer_names:
+            uv_layer = mesh.uv_layers.new(name=uv_layer_name)
+            uv_layer.data.foreach_set("uv", np.concatenate([
+                uvs.get(uv_layer_name, np.zeros(loops_count * 2, dtype=np.float32))
+                for uvs, loops_count in placements_uvs
+            ]))
+        for material in materials:
+            mesh.materials.append(material)
+        mesh.update(calc_edges=True)
+    new_obj = bpy.data.objects.new(name, mesh)
+    bpy.data.collections['Output'].objects.link(new_obj)
+    return new_obj
+
+
+def read_mesh_data(mesh, materials):
+    """ Reads the geometry of a mesh as arrays, its material indices are
+    remapped to the shared materials list, and the uvs of each loop are
+    given by uv layer name """
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    vertex_index = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", vertex_index)
+    loop_start = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_start)
+    loop_total = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", loop_total)
+    material_index = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("material_index", material_index)
+    use_smooth = np.empty(len(mesh.polygons), dtype=bool)
+    mesh.polygons.foreach_get("use_smooth", use_smooth)
+    # Material slot of the mesh -> slot in the merged mesh
+    slots = []
+    for material in mesh.materials:
+        if material not in materials:
+            materials.append(material)
+        slots.append(materials.index(material))
+    if slots:
+        material_index = np.array(slots, dtype=np.int32)[material_index]
+    uvs = {}
+    for uv_layer in mesh.uv_layers:
+        uvs[uv_layer.name] = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+        uv_layer.data.foreach_get("uv", uvs[uv_layer.name])
+    return co.reshape(-1, 3), vertex_index, loop_start, loop_total, material_index, use_smooth, uvs
+
+
+def get_mesh_hash(mesh):
+    """ Hash of the geometry, uvs and materials of a mesh """
+    materials = []
+    *arrays, uvs = read_mesh_data(mesh, materials)
+    content = b"".join(array.tobytes() for array in arrays + list(uvs.values()))
+    content += "\n".join(list(uvs) + [material.name for material in materials]).encode()
+    return hashlib.sha256(content).hexdigest()
+
+
+def get_rotation_matrix(rotation_axes):
+    """ Single matrix for the successive 90 degrees rotations, e.g. "XZ" """
+    matrix = Matrix.Identity(4)
+    for rotation_axis in rotation_axes:
+        if rotation_axis not in "XYZ":
+            print("UNKNOWN ROTATION:", rotation_axis)
+            continue
+        matrix = Matrix.Rotation(math.radians(90), 4, rotation_axis) @ matrix
+    return matrix
+
+
+def get_rotated_mesh(object_name, rotation_axes, mesh_hashes):
+    """ Returns a copy of the object's mesh rotated by the rotation axes. It
+    is kept by Blender between runs (fake user), and reused as long as the
+    original mesh has the same hash. mesh_hashes caches the hash of each
+    original object for the current run """
+    mesh = bpy.data.objects[object_name].data
+    if object_name not in mesh_hashes:
+        mesh_hashes[object_name] = get_mesh_hash(mesh)
+    mesh_name = f"WFC_{object_name}_{rotation_axes}"
+    rotated_mesh = bpy.data.meshes.get(mesh_name)
+    if rotated_mesh is not None:
+        # Materials are compared too, in case a slot was added to the copy
+        # (see add_material)
+        if rotated_mesh.get("wfc_source_hash") == mesh_hashes[object_name] \
+                and list(rotated_mesh.materials) == list(mesh.materials):
+            return rotated_mesh
+        # The original mesh changed since
+        bpy.data.meshes.remove(rotated_mesh)
+    rotated_mesh = mesh.copy()
+    rotated_mesh.name = mesh_name
+    rotated_mesh.transform(get_rotation_matrix(rotation_axes))
+    rotated_mesh["wfc_source_hash"] = mesh_hashes[object_name]
+    rotated_mesh.use_fake_user = True
+    return rotated_mesh
 
 
 def add_material(obj, name, color):
+    """ The material goes to an object level slot, the mesh is shared with
+    the module (and with the original object for unrotated modules) and
+    keeps its own materials """
     mat = bpy.data.materials.get(name)
     if not mat:
         mat = bpy.data.materials.new(name=name)
     mat.diffuse_color = color
-    if obj.data.materials:
-        obj.data.materials[0] = mat
-    else:
-        obj.data.materials.append(mat)
+    if not obj.material_slots:
+        # Object slots mirror the mesh slots, an empty one renders the same
+        obj.data.materials.append(None)
+    obj.material_slots[0].link = 'OBJECT'
+    obj.material_slots[0].material = mat
 
 
 class Module(object):
-    def __init__(self, name, data, rotation, mesh_position):
+    def __init__(self, name, index, ruleset, mesh_position, mesh_hashes):
         self.count = 0
         self.name = name
-        self.rotation = rotation
-        self.self_attraction = data.get("self_attraction", 1)
+        # Position of the module in the ruleset
+        self.index = index
+        self.rotation = ruleset.rotations[index]
+        # Sockets are already rotated by the ruleset
+        self.sockets = ruleset.sockets[index]
 
-        self.sockets = data["sockets"].copy()
-        self.links = []
-        for i in range(6):
-            self.links.append(set())
+        self.original_scene_object_name = ruleset.scene_object_names[index]
+        self.create_transformed_object(self.rotation, mesh_position, mesh_hashes)
 
-        self.original_scene_object_name = data["scene_object_name"]
-        self.create_transformed_object(rotation, mesh_position)
-
-    def create_transformed_object(self, rotation, mesh_position):
+    def create_transformed_object(self, rotation, mesh_position, mesh_hashes):
         """ Mesh position is only needed to neatly present all the generated meshes
         it has no impact on anything else """
         # The name already contains the original object name + the rotation idx
-        # Duplicate the object AND its data
-        # - We don't want the underlying mesh to be the same, otherwise the
-        # rotations won't work
-        if bpy.data.objects[self.original_scene_object_name].data is not None:
+        # Rotated modules get their own rotated copy of the mesh (see
+        # get_rotated_mesh), unless there is no rotation at all, then the
+        # geometry is the same and the original mesh can be shared. Except
+        # with ASSIGN_MATERIAL, which may add a material slot to the mesh
+        original_mesh = bpy.data.objects[self.original_scene_object_name].data
+        if original_mesh is not None and ROTATIONS[rotation]:
             new_obj = bpy.data.objects.new(
                 f"{self.name}",
-                bpy.data.objects[self.original_scene_object_name].data.copy()
+                get_rotated_mesh(self.original_scene_object_name, ROTATIONS[rotation], mesh_hashes)
             )
-        else:  # Needed for empty objects
+        elif original_mesh is not None and ASSIGN_MATERIAL:
+            new_obj = bpy.data.objects.new(f"{self.name}", original_mesh.copy())
+        else:  # Needed for empty objects, and shared by the unrotated ones
             new_obj = bpy.data.objects.new(
                 f"{self.name}",
                 bpy.data.objects[self.original_scene_object_name].data
             )
         # Link to collection
         bpy.data.collections['Generated modules'].objects.link(new_obj)
-        # Rotate
-        x_rotation = Vector3(90, 0, 0)
-        y_rotation = Vector3(0, 90, 0)
-        z_rotation = Vector3(0, 0, 90)
-
-        rotations_order = ROTATIONS[rotation]
-        # Apply each single transformation individually
-        # And swap the sockets to their new direction
-        for rotation_axis in rotations_order:
-            if rotation_axis == "X":
-                blender_rotate(new_obj, x_rotation)
-                self.rotate_sockets(rotation_axis)
-            elif rotation_axis == "Y":
-                blender_rotate(new_obj, y_rotation)
-                self.rotate_sockets(rotation_axis)
-            elif rotation_axis == "Z":
-                blender_rotate(new_obj, z_rotation)
-                self.rotate_sockets(rotation_axis)
-            else:
-                print("UNKNOWN ROTATION:", rotation_axis)
-
         # Translate
         new_obj.location = (mesh_position.x * 4, mesh_position.y * 4, mesh_position.z * 4)
 
-    def rotate_sockets(self, rotation_axis):
-        i0 = self.sockets[0]
-        i1 = self.sockets[1]
-        i2 = self.sockets[2]
-        i3 = self.sockets[3]
-        i4 = self.sockets[4]
-        i5 = self.sockets[5]
-        if rotation_axis == "X":
-            self.sockets[0] = i1
-            self.sockets[1] = i3
-            self.sockets[3] = i4
-            self.sockets[4] = i0
-        elif rotation_axis == "Y":
-            self.sockets[0] = i5
-            self.sockets[2] = i0
-            self.sockets[3] = i2
-            self.sockets[5] = i3
-        elif rotation_axis == "Z":
-            self.sockets[1] = i2
-            self.sockets[2] = i4
-            self.sockets[4] = i5
-            self.sockets[5] = i1
-
-    def create_link(self, nodeB, direction):
-        self.links[direction].add(nodeB)
-
     def __repr__(self):
         return f"{self.name:<25}{self.count}"
 
-        # DEBUG: To display links
-
-        # tmp1 = f"\n{'-'*10} - {self.name}\n"
-        # for index, possible_modules_for_this_direction in enumerate(self.links):
-        #     tmp1 += f"\t{index}: "
-        #     for possible_module in possible_modules_for_this_direction:
-        #         tmp1 += f"{possible_module.name}, "
-        #     tmp1 += '\n'
-        # return tmp1
-
         # DEBUG: To display sockets
 
         # tmp1 = f"\n{'-'*2} - {self.name}\n"
@@ -553,6 +547,51 @@ class Module(object):
         # return tmp1
 
 
+class WFC_OT_solve(bpy.types.Operator):
+    """ Steps the solver of WFC_OT_solve.app by time slices between two
+    viewport updates, see ASYNC_SOLVE. With backtracking, cells are only
+    placed once the map is solved """
+    bl_idname = "wfc.solve"
+    bl_label = "Wave function collapse"
+    # Set by App.run_solver
+    app = None
+
+    def invoke(self, context, event):
+        window_manager = context.window_manager
+        self.timer = window_manager.event_timer_add(ASYNC_UPDATE_INTERVAL, window=context.window)
+        window_manager.modal_handler_add(self)
+        window_manager.progress_begin(0, 100)
+        return {"RUNNING_MODAL"}
+
+    def modal(self, context, event):
+        if event.type == "ESC":
+            print("Solve cancelled")
+            return self.finish(context, {"CANCELLED"})
+        if event.type != "TIMER":
+            return {"PASS_THROUGH"}
+        solver = self.app.solver
+        end = time.perf_counter() + ASYNC_TIME_SLICE
+        solving = True
+        while solving and time.perf_counter() < end:
+            solving = solver.step()
+        if not solving:
+            return self.finish(context, {"FINISHED"})
+        # The cells placed during the slice show up once the operator returns
+        progress = solver.get_progress() * 100
+        context.window_manager.progress_update(progress)
+        context.workspace.status_text_set(
+            f"Wave function collapse: {progress:.1f}%, {solver.stats.collapses_count} collapses (ESC to cancel)"
+        )
+        return {"RUNNING_MODAL"}
+
+    def finish(self, context, result):
+        context.window_manager.event_timer_remove(self.timer)
+        context.window_manager.progress_end()
+        context.workspace.status_text_set(None)
+        self.app.finish_collapse()
+        return result
+
+
 class Vector3(object):
     def __init__(self, x, y, z):
         self.x = x
@@ -564,6 +603,8 @@ class Vector3(object):
 
 
 if __name__ == "__main__":
+    # Registered again on each run, with the newly loaded class
+    bpy.utils.register_class(WFC_OT_solve)
     print("\n"*200)
     print("="*20)
     print("="*20)
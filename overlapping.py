@@ -0,0 +1,112 @@
+""" Overlapping model: instead of hand written sockets, the rules are learned
+from an example grid of module indices (a solved map, a voxelized scene...).
+Every N x N x N block of the example is a pattern, the wave is solved over
+patterns with the usual Solver, and each cell finally gets the module at the
+origin of its pattern """
+import argparse
+import json
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import wfc
+
+
+def get_row_ids(rows):
+    """ Gives the same id to identical rows of a 2D array: each row is seen as
+    a single raw bytes value. Returns the id of each row, and the index of
+    the first row and count of each id, ids follow the order of the first
+    occurrences """
+    rows = np.ascontiguousarray(rows)
+    keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    _, first_indices, ids, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    # np.unique sorts the keys, renumber them by first occurrence instead
+    order = np.argsort(first_indices)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return rank[ids.ravel()], first_indices[order], counts[order]
+
+
+class PatternRuleset(wfc.Ruleset):
+    """ Ruleset whose modules are the patterns of an example grid, weighted by
+    how often they appear. Pattern b can be placed next to pattern a in a
+    direction when they overlap: a without its first layer on that side is
+    b without its last layer.
+    - name_table: the example's name table (see wfc.load_map), to name the
+    patterns after the module at their origin
+    - periodic: the example wraps around, its last cells touch the first ones """
+    def __init__(self, example, pattern_size=2, name_table=None, periodic=False):
+        if pattern_size < 2:
+            raise ValueError(f"Patterns must be at least 2x2x2 to overlap, got a pattern size of {pattern_size}")
+        example = np.asarray(example)
+        self.pattern_size = pattern_size
+        if periodic:
+            example = np.pad(example, [(0, pattern_size - 1)] * 3, mode="wrap")
+        windows = sliding_window_view(example, (pattern_size,) * 3).reshape(-1, pattern_size ** 3)
+        # Blocks with impossible cells aren't patterns
+        windows = windows[(windows >= 0).all(axis=1)]
+        if not len(windows):
+            raise ValueError(f"The example has no {pattern_size}x{pattern_size}x{pattern_size} block without impossible cells")
+        _, first_windows, counts = get_row_ids(windows)
+        self.patterns = windows[first_windows].reshape((-1,) + (pattern_size,) * 3)
+        # Module of the example at the origin of each pattern
+        self.values = self.patterns[:, 0, 0, 0].astype(np.int32)
+
+        self.names = [f"pattern_{index}" for index in range(len(self.patterns))]
+        if name_table is None:
+            self.scene_object_names = [str(value) for value in self.values]
+            self.rotations = [0] * len(self.patterns)
+        else:
+            self.scene_object_names = [name_table[value]["scene_object_name"] for value in self.values]
+            self.rotations = [name_table[value]["rotation"] for value in self.values]
+        # Picking the previous pattern again makes no sense here
+        self.self_attraction = [False] * len(self.patterns)
+        self.sockets = None
+        self.socket_types_count = 0
+        self.variants_count = [1] * len(self.patterns)
+        self.weights = counts.astype(np.float64)
+        self.create_indices()
+        self.create_links()
+
+    def create_links(self):
+        """ Each overlap slab gets an id, patterns overlap when the ids of
+        their facing slabs are equal, no slab is compared with every other """
+        patterns_count = len(self.patterns)
+        self.adjacency = np.zeros((6, patterns_count, patterns_count), dtype=bool)
+        for direction in range(3):
+            # Directions 0 to 2 are positive, their opposite is the negative one
+            axis = 2 - direction % 3
+            upper = np.take(self.patterns, range(1, self.pattern_size), axis=axis + 1)
+            lower = np.take(self.patterns, range(self.pattern_size - 1), axis=axis + 1)
+            slab_ids, _, _ = get_row_ids(np.concatenate([upper, lower]).reshape(2 * patterns_count, -1))
+            upper_ids, lower_ids = slab_ids[:patterns_count], slab_ids[patterns_count:]
+            self.adjacency[direction] = upper_ids[:, None] == lower_ids[None, :]
+            self.adjacency[wfc.get_opposite_direction(direction)] = self.adjacency[direction].T
+
+    def get_module_grid(self, grid):
+        """ Grid of example module indices from a solved grid of pattern
+        indices, -1 stays -1 """
+        return np.where(grid >= 0, self.values[np.maximum(grid, 0)], -1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solve a map with the patterns of an example map")
+    parser.add_argument("example", help="example grid of module indices, see wfc.save_map")
+    parser.add_argument("--pattern-size", type=int, default=2)
+    parser.add_argument("--periodic", action="store_true", help="the example wraps around")
+    parser.add_argument("--size", type=int, nargs=3, default=[10, 10, 10], metavar=("X", "Y", "Z"))
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--backtracking", action="store_true")
+    parser.add_argument("--output", help="save the solved grid of module indices to this .npy file, with the example's name table")
+    args = parser.parse_args()
+
+    example, name_table = wfc.load_map(args.example)
+    ruleset = PatternRuleset(example, args.pattern_size, name_table, args.periodic)
+    solver = wfc.Solver(ruleset, args.size, args.seed, border_module=None, backtracking=args.backtracking)
+    grid = ruleset.get_module_grid(solver.solve())
+    print(f"{len(ruleset)} patterns")
+    print(solver.stats)
+    print(f"{solver.get_impossible_positions_count()}/{grid.size} impossible positions")
+    if args.output:
+        np.save(args.output, grid.astype(wfc.MAP_DTYPE))
+        with open(wfc.get_name_table_path(args.output), "w") as f:
+            json.dump(name_table, f, indent=4)
@@ -0,0 +1,912 @@
+""" Headless wave function collapse solver, it only needs the modules json
+(win_tubes.json, path.json...) and has no dependency on Blender, main.py
+is the Blender output on top of it """
+import argparse
+import contextlib
+import glob
+import hashlib
+import heapq
+import json
+import math
+import os
+import random
+import time
+import numpy as np
+from collections import deque
+
+EMPTY_MODULE_NAME = "Empty_0"
+MAX_CONSECUTIVE_OVERRIDES = 5
+# Backtracking: how many past decisions can be undone, how many undos are
+# allowed before restarting with a new seed, and how many restarts before
+# giving up and accepting impossible cells
+MAX_BACKTRACK_DEPTH = 100
+MAX_BACKTRACKS = 1000
+MAX_RESTARTS = 10
+# Compiled rulesets are cached in this directory, next to the modules json
+RULESET_CACHE_DIR = ".ruleset_cache"
+# Bump when the content of the cached rulesets changes
+RULESET_CACHE_VERSION = 3
+# Trace records: tick (collapses made so far), flat cell index, module index
+# and what happened to the cell
+TRACE_DTYPE = np.dtype([("tick", "<u4"), ("cell", "<u4"), ("module", "<u2"), ("kind", "u1")])
+TRACE_COLLAPSE = 0  # Chosen by the solver
+TRACE_PROPAGATE = 1  # Left with a single module by the propagation
+TRACE_UNDO = 2  # Undone by backtracking
+TRACE_BUFFER_SIZE = 65536
+# Weighted choice: draws among all the modules tried before computing the
+# choice among the possible ones only, see Solver.choose_weighted_module
+WEIGHTED_CHOICE_TRIES = 8
+# Entropies are rounded to this many decimals, the running sums drift a
+# little and cells with the same possible modules must still tie
+ENTROPY_DECIMALS = 9
+# Solver.on_progress is called every PROGRESS_INTERVAL collapses
+PROGRESS_INTERVAL = 100
+# Module index of each cell in saved maps, -1 for impossible cells, see save_map
+MAP_DTYPE = np.int16
+ROTATIONS = [
+"", "X", "Y", "Z", "XX", "XY", "XZ", "YX", "YY", "ZY", "ZZ", "XXX", "XXY",
+"XXZ", "XYX", "XYY", "XZZ", "YXX", "YYY", "ZZZ", "XXXY", "XXYX", "XYXX", "XYYY"
+]
+# ROTATIONS = [
+# "", "Z", "ZZ", "ZZZ"
+# ]
+# Offset to the neighbor cell for each direction:
+# top, back, right, bottom, front, left
+DIRECTIONS = [
+    (0, 0, 1), (0, 1, 0), (1, 0, 0), (0, 0, -1), (0, -1, 0), (-1, 0, 0)
+]
+# Order in which the neighbors are visited during propagation:
+# top, bottom, front, back, left, right
+PROPAGATION_ORDER = [0, 3, 4, 1, 5, 2]
+
+
+def get_opposite_direction(direction):
+    return (direction + 3) % 6
+
+
+def rotate_sockets(sockets, rotation_axis):
+    """ Returns the sockets swapped to their new direction after a 90 degrees
+    rotation around the given axis """
+    i0, i1, i2, i3, i4, i5 = sockets
+    rotated = list(sockets)
+    if rotation_axis == "X":
+        rotated[0] = i1
+        rotated[1] = i3
+        rotated[3] = i4
+        rotated[4] = i0
+    elif rotation_axis == "Y":
+        rotated[0] = i5
+        rotated[2] = i0
+        rotated[3] = i2
+        rotated[5] = i3
+    elif rotation_axis == "Z":
+        rotated[1] = i2
+        rotated[2] = i4
+        rotated[4] = i5
+        rotated[5] = i1
+    else:
+        print("UNKNOWN ROTATION:", rotation_axis)
+    return rotated
+
+
+class Ruleset(object):
+    """ All the modules of a json, expanded with their rotations, and the
+    adjacency rules between them. Modules are addressed by their index """
+    def __init__(self, modules_data, rotations=ROTATIONS):
+        self.names = []
+        self.scene_object_names = []
+        self.rotations = []
+        self.self_attraction = []
+        self.sockets = []
+        # Number of rotations merged into each module, see below
+        self.variants_count = []
+        # Relative frequency of each module given in the json, "weight"
+        module_weights = []
+        self.socket_types_count = 0
+        for module in modules_data:
+            if module.get("weight", 1) <= 0:
+                raise ValueError(f"""{module["module_name"]}: weight must be positive""")
+            # Only needed to get total socket_types_count
+            for directions in module["sockets"]:
+                for socket_type in directions:
+                    if socket_type > self.socket_types_count:
+                        self.socket_types_count = socket_type
+            module_rotations = module["rotations"]
+            if module_rotations[0] == -1:
+                module_rotations = [idx for idx in range(len(rotations))]
+            # Rotations giving the same sockets layout (hub, straight lines...)
+            # are the same module for the solver, only the first one is kept
+            # unless the module opts out (e.g. decorations breaking the symmetry)
+            deduplicate = module.get("deduplicate", True)
+            layouts = {}
+            for rotation in module_rotations:
+                sockets = [list(socket_types) for socket_types in module["sockets"]]
+                for rotation_axis in rotations[rotation]:
+                    sockets = rotate_sockets(sockets, rotation_axis)
+                layout = tuple(tuple(sorted(set(socket_types))) for socket_types in sockets)
+                if deduplicate and layout in layouts:
+                    self.variants_count[layouts[layout]] += 1
+                    continue
+                layouts[layout] = len(self.names)
+                self.variants_count.append(1)
+                module_weights.append(module.get("weight", 1))
+                self.names.append(f"""{module["module_name"]}_{rotation}""")
+                self.scene_object_names.append(module["scene_object_name"])
+                self.rotations.append(rotation)
+                self.self_attraction.append(bool(module.get("self_attraction", 1)))
+                self.sockets.append(sockets)
+        # A module merging several rotations is as likely as all of them together
+        self.weights = np.array(module_weights, dtype=np.float64) * self.variants_count
+        self.create_indices()
+        self.create_links()
+
+    def create_indices(self):
+        self.indices = {name: index for index, name in enumerate(self.names)}
+        # Index of the original scene object of each module, the "lowest"
+        # choice strategy counts placements per original object
+        scene_objects = {}
+        self.scene_object_ids = np.array([
+            scene_objects.setdefault(name, len(scene_objects)) for name in self.scene_object_names
+        ], dtype=np.int32)
+        self.scene_objects_count = len(scene_objects)
+        # For the Shannon entropy of a cell: log(sum(w)) - sum(w log w) / sum(w)
+        self.weight_log_weights = self.weights * np.log(self.weights)
+        # For the weighted choice among all the modules
+        self.cumulative_weights = np.cumsum(self.weights)
+
+    @classmethod
+    def from_json(cls, filepath, rotations=ROTATIONS, use_cache=True):
+        """ The compiled ruleset is cached next to the json, and reused as long
+        as neither the json content nor the rotations change """
+        with open(filepath, "rb") as f:
+            content = f.read()
+        if not use_cache:
+            return cls(json.loads(content), rotations)
+        key = hashlib.sha256(content + json.dumps([RULESET_CACHE_VERSION, rotations]).encode()).hexdigest()[:16]
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), RULESET_CACHE_DIR)
+        cache_path = os.path.join(cache_dir, f"{os.path.basename(filepath)}.{key}.npz")
+        if os.path.exists(cache_path):
+            return cls.load(cache_path)
+        ruleset = cls(json.loads(content), rotations)
+        # Outdated rulesets of the same json, a parallel run may be removing
+        # them too, or writing the current one
+        for outdated_path in glob.glob(os.path.join(glob.escape(cache_dir), f"{glob.escape(os.path.basename(filepath))}.*.npz")):
+            if outdated_path != cache_path:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(outdated_path)
+        ruleset.save(cache_path)
+        return ruleset
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Write then rename, so a parallel run never loads half a file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                names=np.array(self.names),
+                scene_object_names=np.array(self.scene_object_names),
+                rotations=np.array(self.rotations, dtype=np.int32),
+                variants_count=np.array(self.variants_count, dtype=np.int32),
+                weights=self.weights,
+                self_attraction=np.array(self.self_attraction, dtype=bool),
+                sockets=np.array(json.dumps(self.sockets)),
+                socket_types_count=np.array(self.socket_types_count),
+                adjacency=np.packbits(self.adjacency),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        ruleset = cls.__new__(cls)
+        with np.load(path) as data:
+            ruleset.names = data["names"].tolist()
+            ruleset.scene_object_names = data["scene_object_names"].tolist()
+            ruleset.rotations = data["rotations"].tolist()
+            ruleset.variants_count = data["variants_count"].tolist()
+            ruleset.weights = data["weights"]
+            ruleset.self_attraction = data["self_attraction"].tolist()
+            ruleset.sockets = json.loads(data["sockets"].item())
+            ruleset.socket_types_count = int(data["socket_types_count"])
+            modules_count = len(ruleset.names)
+            ruleset.adjacency = np.unpackbits(
+                data["adjacency"], count=6 * modules_count * modules_count
+            ).reshape(6, modules_count, modules_count).astype(bool)
+        ruleset.create_indices()
+        return ruleset
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_modules_mask(self, modules):
+        """ Boolean mask of the given modules: indices, module names, or
+        original scene object names standing for all their rotations """
+        mask = np.zeros(len(self), dtype=bool)
+        for module in modules:
+            if not isinstance(module, str):
+                mask[module] = True
+            elif module in self.indices:
+                mask[self.indices[module]] = True
+            else:
+                rotations = np.array(self.scene_object_names) == module
+                if not rotations.any():
+                    raise ValueError(f"Unknown module {module}")
+                mask |= rotations
+        return mask
+
+    def create_links(self):
+        """ Compiles the sockets into one boolean adjacency matrix per direction:
+        self.adjacency[direction][a, b] is True when module b can be placed
+        next to module a in this direction """
+        modules_count = len(self.names)
+        # For each direction, which socket types each module exposes
+        sockets = np.zeros((6, modules_count, self.socket_types_count + 1), dtype=np.int32)
+        for index, module_sockets in enumerate(self.sockets):
+            for direction, socket_types in enumerate(module_sockets):
+                sockets[direction, index, socket_types] = 1
+        self.adjacency = np.zeros((6, modules_count, modules_count), dtype=bool)
+        for direction in range(6):
+            # Two modules match if they share at least one socket type
+            # on their facing sides
+            opposite_sockets = sockets[get_opposite_direction(direction)]
+            self.adjacency[direction] = (sockets[direction] @ opposite_sockets.T) > 0
+
+
+class SolverStats(object):
+    """ Counters and wall time per phase of a solve. The time is charged to
+    the current phase until the solver enters another one, so the phases
+    don't overlap: the time spent in on_cell_set is "output" and not part of
+    the propagation calling it """
+    PHASES = ["setup", "select", "choose", "propagate", "backtrack", "output", "caller"]
+
+    def __init__(self):
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.phase = "setup"
+        self.phase_start = time.perf_counter()
+        self.collapses_count = 0
+        self.overrides_count = 0
+        self.propagation_visited_cells = 0
+        self.propagation_removed_modules = 0
+        self.contradictions_count = 0
+        self.backtracks_count = 0
+        self.restarts_count = 0
+        # Share of the cells finished, updated with on_progress
+        self.progress = 0.0
+
+    def enter(self, phase):
+        """ Switches to the phase, and returns the previous one """
+        now = time.perf_counter()
+        previous_phase = self.phase
+        self.times[previous_phase] += now - self.phase_start
+        self.phase = phase
+        self.phase_start = now
+        return previous_phase
+
+    def __repr__(self):
+        # "caller" is the time spent outside of the solver, between two steps
+        solver_time = sum(self.times.values()) - self.times["caller"]
+        lines = [
+            f"{self.collapses_count} collapses, {self.overrides_count} overrides",
+            f"{self.propagation_visited_cells} cells visited, {self.propagation_removed_modules} modules removed during propagation",
+            f"{self.contradictions_count} contradictions, {self.backtracks_count} backtracks, {self.restarts_count} restarts",
+        ]
+        for phase in self.PHASES[:-1]:
+            share = self.times[phase] / solver_time * 100 if solver_time else 0
+            lines.append(f"{phase:<10}{self.times[phase]:8.3f}s {share:5.1f}%")
+        return "\n".join(lines)
+
+
+class Trace(object):
+    """ Binary log of the cells set by the solver: fixed width TRACE_DTYPE
+    records, buffered in an array and written in bulk. Read it back with
+    read_trace. With append, the records go after the ones already in the
+    file """
+    def __init__(self, path, buffer_size=TRACE_BUFFER_SIZE, append=False):
+        self.file = open(path, "ab" if append else "wb")
+        self.buffer = np.empty(buffer_size, dtype=TRACE_DTYPE)
+        self.count = 0
+
+    def record(self, tick, cell, module_index, kind):
+        self.buffer[self.count] = (tick, cell, module_index, kind)
+        self.count += 1
+        if self.count == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer[:self.count].tobytes())
+        self.file.flush()
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_trace(path):
+    return np.fromfile(path, dtype=TRACE_DTYPE)
+
+
+def get_name_table_path(path):
+    return os.path.splitext(path)[0] + ".json"
+
+
+def write_name_table(path, ruleset):
+    """ Writes the json describing the module indices of the map saved at
+    path: name, original scene object and rotation of each module """
+    with open(get_name_table_path(path), "w") as f:
+        json.dump([
+            {"name": name, "scene_object_name": scene_object_name, "rotation": rotation}
+            for name, scene_object_name, rotation in zip(ruleset.names, ruleset.scene_object_names, ruleset.rotations)
+        ], f, indent=4)
+
+
+def save_map(path, grid, ruleset):
+    """ Saves a grid of module indices as a MAP_DTYPE .npy file, with its
+    name table next to it """
+    np.save(path, grid.astype(MAP_DTYPE))
+    write_name_table(path, ruleset)
+
+
+def load_map(path, mmap_mode="r"):
+    """ Returns the grid of module indices saved at path, memory mapped by
+    default so only the cells read are loaded, and its name table """
+    with open(get_name_table_path(path), "r") as f:
+        name_table = json.load(f)
+    return np.load(path, mmap_mode=mmap_mode), name_table
+
+
+class Decision(object):
+    """ A collapse made by the solver, with everything needed to undo it """
+    def __init__(self, cell, module_index, placements_count, last_chosen_module, consecutive_overrides_count):
+        self.cell = cell
+        self.module_index = module_index
+        # (cell, previous wave, previous possibilities count) of each cell
+        # modified by this decision and its propagation
+        self.changes = []
+        self.placements_count = placements_count
+        self.last_chosen_module = last_chosen_module
+        self.consecutive_overrides_count = consecutive_overrides_count
+
+
+class Solver(object):
+    """ Wave function collapse on a grid of the given size, cells are (x, y, z)
+    tuples and modules are indices in the ruleset.
+    on_cell_set(cell, module_index, chosen) is called each time a cell gets its
+    final module, chosen is False when the cell was collapsed by propagation.
+    With backtracking, contradictions are undone as soon as a cell runs out of
+    possibilities, and on_cell_set is only called once the map is solved.
+    on_cell_unset(cell, module_index) is called when reset_region reopens a
+    cell which had its final module.
+    trace is an optional Trace, off by default.
+    on_progress(stats) is called every PROGRESS_INTERVAL collapses, the
+    counters and timings of the solve are in self.stats.
+    constraints narrows the possible modules of cells before solving, either
+    a boolean mask of the wave's shape (or broadcastable to it), or a list of
+    (cell, modules) pairs, cell being an (x, y, z) tuple or a tuple of slices
+    for a box, see Ruleset.get_modules_mask for the modules """
+    def __init__(self, ruleset, size, seed=None, strategy="override",
+                 border_module=EMPTY_MODULE_NAME, on_cell_set=None, backtracking=False,
+                 trace=None, on_progress=None, on_cell_unset=None, constraints=None):
+        self.ruleset = ruleset
+        self.size = tuple(size)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.strategy = strategy
+        self.border_module = border_module
+        self.constraints = constraints
+        self.on_cell_set = on_cell_set
+        self.on_cell_unset = on_cell_unset
+        self.backtracking = backtracking
+        # Turned off once out of restarts
+        self.recovering = backtracking
+        self.trace = trace
+        self.on_progress = on_progress
+        # Number of collapses made, used as the trace's clock
+        self.tick = 0
+        self.stats = SolverStats()
+        # Restarts of the current solve, see restart
+        self.restarts_count = 0
+        # Boolean mask of the cells being solved again, see reset_region
+        self.region = None
+
+        self.handle_map_creation()
+        self.stats.enter("caller")
+
+    def handle_map_creation(self):
+        # Modules data recording
+        self.last_chosen_module = None
+        self.consecutive_overrides_count = 0
+        self.scene_objects_count = np.zeros(self.ruleset.scene_objects_count, dtype=np.int32)
+        # Undoable decisions, the oldest ones are forgotten past MAX_BACKTRACK_DEPTH
+        self.decisions = deque(maxlen=MAX_BACKTRACK_DEPTH)
+        self.attempt_backtracks_count = 0
+        # With backtracking, (cell, module index, chosen) of each cell set,
+        # given to on_cell_set once the map is solved
+        self.placements = []
+
+        # Initialize the wave: one boolean per (cell, module index), True
+        # while the module is still possible for the cell
+        modules_count = len(self.ruleset)
+        self.wave = np.ones(self.size + (modules_count,), dtype=bool)
+        # Number of possible modules per cell, and running sums of w and w log w
+        # over the possible modules for the entropy, kept in sync with the wave
+        self.possibilities_count = np.full(self.size, modules_count, dtype=np.int32)
+        self.sum_weights = np.full(self.size, self.ruleset.weights.sum())
+        self.sum_weight_log_weights = np.full(self.size, self.ruleset.weight_log_weights.sum())
+        # Priority queue of (entropy, random tie-break, cell) entries,
+        # see push_entropy and get_minimal_entropy_cell
+        self.entropy_heap = []
+
+        # The border and the constraints are propagated in a single pass
+        self.apply_constraints()
+        for x, y, z in np.argwhere(self.possibilities_count > 1):
+            self.push_entropy((int(x), int(y), int(z)))
+
+    def apply_constraints(self, box=None):
+        """ Narrows the cells of box (slices, the whole map by default) to the
+        border module on the outer shell of the map and to the constraints,
+        then propagates all the changes at once. Returns False on contradiction """
+        phase = self.stats.enter("propagate")
+        box = box or tuple(slice(0, axis_size) for axis_size in self.size)
+        changed_cells = {}
+        if self.border_module is not None:
+            border_mask = self.ruleset.get_modules_mask([self.border_module])
+            for axis in range(3):
+                for side in [0, -1]:
+                    face = [slice(None)] * 3
+                    face[axis] = side
+                    self.narrow(self.get_box(face, box), border_mask, changed_cells)
+        if isinstance(self.constraints, np.ndarray):
+            self.narrow(box, np.broadcast_to(self.constraints, self.wave.shape), changed_cells)
+        elif self.constraints is not None:
+            for index, modules in self.constraints:
+                self.narrow(self.get_box(index, box), self.ruleset.get_modules_mask(modules), changed_cells)
+        consistent = self.propagate_changes(changed_cells)
+        self.stats.enter(phase)
+        return consistent
+
+    def solve(self):
+        """ Collapses the whole map and returns the solved grid of module indices """
+        while self.step():
+            pass
+        return self.get_grid()
+
+    def iter_placements(self):
+        """ Collapses the whole map, yielding (cell, module name, rotation, tick)
+        each time a cell gets its final module. Cells set before the first step
+        (border, constraints) come first. With backtracking everything comes
+        once the map is solved, on_cell_set is still called """
+        on_cell_set = self.on_cell_set
+        placements = []
+
+        def record_placement(cell, module_index, chosen):
+            if on_cell_set is not None:
+                on_cell_set(cell, module_index, chosen)
+            placements.append((cell, module_index, self.tick))
+
+        if not self.backtracking:
+            for x, y, z in np.argwhere(self.possibilities_count == 1):
+                placements.append(((int(x), int(y), int(z)), int(self.wave[x, y, z].argmax()), self.tick))
+        self.on_cell_set = record_placement
+        try:
+            solving = True
+            while solving:
+                solving = self.step()
+                for cell, module_index, tick in placements:
+                    yield cell, self.ruleset.names[module_index], self.ruleset.rotations[module_index], tick
+                placements.clear()
+        finally:
+            self.on_cell_set = on_cell_set
+
+    def step(self):
+        """ Collapses a single cell and propagates the consequences, returns
+        False once there is no cell left to collapse """
+        # Get the next cell to update
+        self.stats.enter("select")
+        cell = self.get_minimal_entropy_cell()
+        if cell is None:
+            self.stats.enter("output")
+            if self.backtracking and self.on_cell_set is not None:
+                for placement in self.placements:
+                    self.on_cell_set(*placement)
+            # The solve is over, a later restart (see reset_region) must not undo these cells
+            self.placements = []
+            if self.trace is not None:
+                self.trace.flush()
+            self.stats.enter("caller")
+            return False
+        self.tick += 1
+        self.stats.collapses_count += 1
+        self.stats.enter("choose")
+        module_index = self.choose_module_from_possibilities(cell, self.strategy)
+        if self.recovering:
+            self.decisions.append(Decision(
+                cell, module_index, len(self.placements),
+                self.last_chosen_module, self.consecutive_overrides_count
+            ))
+        self.stats.enter("propagate")
+        self.set_cell(cell, module_index)
+        # Now propagate to neighbors
+        if not self.update_possibilities(cell):
+            self.stats.contradictions_count += 1
+            if self.recovering:
+                self.stats.enter("backtrack")
+                self.backtrack()
+        if self.on_progress is not None and self.stats.collapses_count % PROGRESS_INTERVAL == 0:
+            self.stats.enter("output")
+            self.stats.progress = self.get_progress()
+            self.on_progress(self.stats)
+        self.stats.enter("caller")
+        return True
+
+    def backtrack(self):
+        """ Undoes the latest decisions until the map is consistent again, the
+        module chosen by an undone decision is banned from its cell """
+        while self.decisions and self.attempt_backtracks_count < MAX_BACKTRACKS:
+            self.stats.backtracks_count += 1
+            self.attempt_backtracks_count += 1
+            decision = self.decisions.pop()
+            self.undo_decision(decision)
+            # The ban itself belongs to the previous decision, and is undone with it
+            cell_wave = self.wave[decision.cell].copy()
+            cell_wave[decision.module_index] = False
+            self.update_cell(decision.cell, cell_wave)
+            if self.possibilities_count[decision.cell] > 0 and self.update_possibilities(decision.cell):
+                return
+            self.stats.contradictions_count += 1
+        self.restart()
+
+    def undo_decision(self, decision):
+        for cell, cell_wave, possibilities_count, sum_weights, sum_weight_log_weights in reversed(decision.changes):
+            self.wave[cell] = cell_wave
+            self.possibilities_count[cell] = possibilities_count
+            self.sum_weights[cell] = sum_weights
+            self.sum_weight_log_weights[cell] = sum_weight_log_weights
+            if possibilities_count > 1:
+                self.push_entropy(cell)
+        for cell, module_index, chosen in self.placements[decision.placements_count:]:
+            self.unrecord_cell(cell, module_index)
+        del self.placements[decision.placements_count:]
+        self.last_chosen_module = decision.last_chosen_module
+        self.consecutive_overrides_count = decision.consecutive_overrides_count
+
+    def restart(self):
+        """ Starts again from an empty map (or region, see reset_region) with a
+        new seed, once out of restarts the last attempt runs without
+        backtracking and keeps its impossible cells """
+        if self.restarts_count >= MAX_RESTARTS:
+            self.recovering = False
+        self.restarts_count += 1
+        self.stats.restarts_count += 1
+        self.seed = self.random.randrange(2**32)
+        self.random = random.Random(self.seed)
+        # Restarts only happen with backtracking, so every cell set during
+        # this attempt is still in the placements
+        for cell, module_index, chosen in self.placements:
+            self.unrecord_cell(cell, module_index)
+        self.placements = []
+        if self.region is None:
+            self.handle_map_creation()
+            return
+        # Only the region and the cells around it may have changed since it
+        # was reset, the rest of the map is kept
+        self.decisions.clear()
+        self.attempt_backtracks_count = 0
+        shell = self.region_shell
+        self.wave[shell] = self.region_shell_wave
+        self.possibilities_count[shell] = np.count_nonzero(self.region_shell_wave, axis=-1)
+        self.sum_weights[shell] = self.region_shell_wave @ self.ruleset.weights
+        self.sum_weight_log_weights[shell] = self.region_shell_wave @ self.ruleset.weight_log_weights
+        self.open_region()
+
+    def reset_region(self, start, end):
+        """ Reopens the cells of the box between start (included) and end
+        (excluded) so the next solve only collapses them again, constrained
+        by the cells around the box, the rest of the map is kept. The border
+        and the constraints still apply to the region. Returns False if the
+        cells around the box leave no solution to some cell of the region """
+        self.region_box = self.get_box([slice(max(a, 0), b) for a, b in zip(start, end)])
+        self.region = np.zeros(self.size, dtype=bool)
+        if self.region_box is not None:
+            self.region[self.region_box] = True
+        # Propagation from the region may only narrow the cells around it,
+        # they are saved to be put back by restart
+        self.region_shell = np.zeros(self.size, dtype=bool)
+        self.region_shell[tuple(slice(max(a - 1, 0), b + 1) for a, b in zip(start, end))] = True
+        for x, y, z in np.argwhere(self.region & (self.possibilities_count == 1)):
+            cell = (int(x), int(y), int(z))
+            module_index = int(self.wave[cell].argmax())
+            self.unrecord_cell(cell, module_index)
+            if self.on_cell_unset is not None:
+                self.on_cell_unset(cell, module_index)
+        self.region_shell &= ~self.region
+        self.region_shell_wave = self.wave[self.region_shell]
+        self.placements = []
+        self.decisions.clear()
+        self.attempt_backtracks_count = 0
+        self.restarts_count = 0
+        self.recovering = self.backtracking
+        return self.open_region()
+
+    def open_region(self):
+        """ Makes every allowed module possible again in the region, then
+        propagates the constraints of the cells around it """
+        region = self.region
+        self.wave[region] = True
+        self.possibilities_count[region] = len(self.ruleset)
+        self.sum_weights[region] = self.ruleset.weights.sum()
+        self.sum_weight_log_weights[region] = self.ruleset.weight_log_weights.sum()
+        # The rest of the map already fits the constraints
+        consistent = self.region_box is None or self.apply_constraints(self.region_box)
+        if not self.update_possibilities(*[
+            (int(x), int(y), int(z)) for x, y, z in np.argwhere(self.region_shell & (self.possibilities_count > 0))
+        ]):
+            self.stats.contradictions_count += 1
+            consistent = False
+        # Cells left untouched by the propagation still have to be scheduled
+        for x, y, z in np.argwhere((region | self.region_shell) & (self.possibilities_count > 1)):
+            self.push_entropy((int(x), int(y), int(z)))
+        return consistent
+
+    def save_cell(self, cell):
+        """ Remembers the cell as it is now, so the latest decision can be undone """
+        if self.decisions:
+            self.decisions[-1].changes.append((
+                cell, self.wave[cell].copy(), int(self.possibilities_count[cell]),
+                self.sum_weights[cell], self.sum_weight_log_weights[cell]
+            ))
+
+    def get_box(self, index, box=None):
+        """ Slices of the cells at index, three ints or slices (with a step of
+        1), within box if given. None if there is no such cell """
+        slices = []
+        for axis, (item, axis_size) in enumerate(zip(index, self.size)):
+            if isinstance(item, slice):
+                start, stop, step = item.indices(axis_size)
+                if step != 1:
+                    raise ValueError(f"Cells can't be selected with a step ({item})")
+            else:
+                start = range(axis_size)[item]
+                stop = start + 1
+            if box is not None:
+                start, stop = max(start, box[axis].start), min(stop, box[axis].stop)
+            if start >= stop:
+                return None
+            slices.append(slice(start, stop))
+        return tuple(slices)
+
+    def narrow(self, box, allowed, changed_cells):
+        """ Removes the modules which are not allowed from the cells of box
+        (see get_box), allowed is either a mask of the modules or an array
+        of the wave's shape. The changed cells are added to changed_cells,
+        a dict used as an ordered set. Goes one x layer at a time, so
+        temporary arrays stay small whatever the size of the map """
+        if box is None:
+            return
+        for x in range(box[0].start, box[0].stop):
+            layer = (x, box[1], box[2])
+            restricted_wave = self.wave[layer] & (allowed if allowed.ndim == 1 else allowed[layer])
+            restricted_count = np.count_nonzero(restricted_wave, axis=-1)
+            for y, z in np.argwhere(restricted_count != self.possibilities_count[layer]):
+                cell = (x, box[1].start + int(y), box[2].start + int(z))
+                self.update_cell(cell, restricted_wave[y, z])
+                changed_cells[cell] = None
+
+    def propagate_changes(self, changed_cells):
+        """ Propagates the cells changed by narrow at once, returns False on
+        contradiction """
+        # Emptied cells have nothing left to propagate
+        emptied = any(self.possibilities_count[cell] == 0 for cell in changed_cells)
+        consistent = self.update_possibilities(*[cell for cell in changed_cells if self.possibilities_count[cell] > 0])
+        if not consistent or emptied:
+            self.stats.contradictions_count += 1
+            return False
+        return True
+
+    def get_grid(self):
+        """ Returns the module index of each cell, -1 for cells without a
+        final module (impossible or not collapsed yet) """
+        grid = np.full(self.size, -1, dtype=np.int32)
+        collapsed = self.possibilities_count == 1
+        grid[collapsed] = self.wave[collapsed].argmax(axis=-1)
+        return grid
+
+    def get_cell_index(self, cell):
+        """ Index of the cell in the flattened grid """
+        return (cell[0] * self.size[1] + cell[1]) * self.size[2] + cell[2]
+
+    def get_progress(self):
+        """ Share of the cells which are done: collapsed or impossible """
+        return np.count_nonzero(self.possibilities_count < 2) / self.possibilities_count.size
+
+    def get_impossible_positions_count(self):
+        return int(np.count_nonzero(self.possibilities_count == 0))
+
+    def choose_module_from_possibilities(self, cell, type="override"):
+        res = self.wave[cell]
+        possible_weight = self.sum_weights[cell]
+        if type == "lowest":
+            # Modules whose original object has been placed the least
+            counts = self.scene_objects_count[self.ruleset.scene_object_ids]
+            res = res & (counts == counts[res].min())
+            possible_weight = None
+        elif type == "override":
+            if self.last_chosen_module is not None and self.wave[cell][self.last_chosen_module]:
+                if self.ruleset.self_attraction[self.last_chosen_module]:
+                    self.stats.overrides_count += 1
+                    self.consecutive_overrides_count += 1
+                    if self.consecutive_overrides_count < MAX_CONSECUTIVE_OVERRIDES:
+                        return self.last_chosen_module
+            self.consecutive_overrides_count = 0
+        elif type == "empty":
+            empty_index = self.ruleset.indices[EMPTY_MODULE_NAME]
+            if self.wave[cell][empty_index] and self.random.randint(0, 2) != 0:
+                return empty_index
+        return self.choose_weighted_module(res, possible_weight)
+
+    def choose_weighted_module(self, possible_modules, possible_weight=None):
+        """ Picks one of the possible modules (boolean mask) at random,
+        proportionally to their weight. A module is drawn among all of them,
+        with a binary search in the ruleset's cumulative weights, until a
+        possible one comes out: O(log modules) per try. Only tried if the
+        possible modules are likely enough to come out, given their total
+        weight (sum_weights of the cell). Otherwise, or when out of tries, the
+        cumulative weights of the possible modules are computed, O(modules) """
+        all_cumulative_weights = self.ruleset.cumulative_weights
+        total_weight = all_cumulative_weights[-1]
+        if possible_weight is not None and possible_weight * WEIGHTED_CHOICE_TRIES >= total_weight:
+            for _ in range(WEIGHTED_CHOICE_TRIES):
+                module_index = int(np.searchsorted(all_cumulative_weights, self.random.random() * total_weight, side="right"))
+                # Guard against float rounding on the last module
+                module_index = min(module_index, len(all_cumulative_weights) - 1)
+                if possible_modules[module_index]:
+                    return module_index
+        cumulative_weights = np.cumsum(self.ruleset.weights * possible_modules)
+        module_index = int(np.searchsorted(cumulative_weights, self.random.random() * cumulative_weights[-1], side="right"))
+        # Guard against float rounding on the last possible module
+        return min(module_index, int(np.flatnonzero(possible_modules)[-1]))
+
+#########################################
+# WFC algorithm functions
+    def set_cell(self, cell, module_index):
+        self.last_chosen_module = module_index  # For override
+        # Assign cell
+        cell_wave = np.zeros(len(self.ruleset), dtype=bool)
+        cell_wave[module_index] = True
+        self.update_cell(cell, cell_wave, True)
+
+    def update_cell(self, cell, cell_wave, chosen=False):
+        """ Replaces the possible modules of the cell, updating everything kept
+        in sync with the wave """
+        self.save_cell(cell)
+        removed = self.wave[cell] & ~cell_wave
+        self.sum_weights[cell] -= self.ruleset.weights[removed].sum()
+        self.sum_weight_log_weights[cell] -= self.ruleset.weight_log_weights[removed].sum()
+        self.wave[cell] = cell_wave
+        self.possibilities_count[cell] = np.count_nonzero(cell_wave)
+        if self.possibilities_count[cell] > 1:
+            self.push_entropy(cell)
+        elif self.possibilities_count[cell] == 1:
+            self.record_cell(cell, int(cell_wave.argmax()), chosen)
+
+    def record_cell(self, cell, module_index, chosen):
+        # For minimal module count choice
+        self.scene_objects_count[self.ruleset.scene_object_ids[module_index]] += 1
+        if self.trace is not None:
+            self.trace.record(
+                self.tick, self.get_cell_index(cell), module_index,
+                TRACE_COLLAPSE if chosen else TRACE_PROPAGATE
+            )
+        if self.backtracking:
+            self.placements.append((cell, module_index, chosen))
+        elif self.on_cell_set is not None:
+            phase = self.stats.enter("output")
+            self.on_cell_set(cell, module_index, chosen)
+            self.stats.enter(phase)
+
+    def unrecord_cell(self, cell, module_index):
+        """ Forgets a cell which had its final module, see record_cell """
+        self.scene_objects_count[self.ruleset.scene_object_ids[module_index]] -= 1
+        if self.trace is not None:
+            self.trace.record(self.tick, self.get_cell_index(cell), module_index, TRACE_UNDO)
+
+    def update_possibilities(self, *cells):
+        """ Propagates the constraints of the cells to the whole map, using a
+        worklist of cells whose possibilities changed instead of recursion.
+        Returns False if a cell ran out of possibilities, with backtracking
+        the propagation stops right there """
+        consistent = True
+        to_be_updated_cells = deque(cells)
+        # Cells already waiting in the worklist, so each one is queued once
+        queued_cells = set(cells)
+        while to_be_updated_cells:
+            cell = to_be_updated_cells.popleft()
+            queued_cells.discard(cell)
+            self.stats.propagation_visited_cells += 1
+            for neighbor, direction in self.get_neighbors(cell):
+                # Impossible cells can't be narrowed anymore. While recovering,
+                # finished cells are still checked: two neighbors collapsed by
+                # the same propagation may not fit together, and the decision is
+                # undone. Otherwise a finished cell was already given to
+                # on_cell_set and is kept as is
+                if self.possibilities_count[neighbor] < (1 if self.recovering else 2):
+                    continue
+                # Propagate the collapse to neighbor which had changes
+                if self.update_neighbor(cell, neighbor, direction):
+                    if self.possibilities_count[neighbor] == 0:
+                        consistent = False
+                        if self.recovering:
+                            return False
+                    elif neighbor not in queued_cells:
+                        queued_cells.add(neighbor)
+                        to_be_updated_cells.append(neighbor)
+        return consistent
+
+    def get_neighbors(self, cell):
+        """ Yields each neighbor inside the map, with the direction leading
+        from the cell to it """
+        x, y, z = cell
+        for direction in PROPAGATION_ORDER:
+            dx, dy, dz = DIRECTIONS[direction]
+            neighbor = (x + dx, y + dy, z + dz)
+            if 0 <= neighbor[0] < self.size[0] and 0 <= neighbor[1] < self.size[1] and 0 <= neighbor[2] < self.size[2]:
+                yield neighbor, direction
+
+    def update_neighbor(self, cell, neighbor, direction):
+        # Union of the possibilities allowed by each possible module of the cell
+        # in this direction
+        a_possible_neighbors = self.ruleset.adjacency[direction][self.wave[cell]].any(axis=0)
+        # Remove impossible modules
+        tmp = self.wave[neighbor] & a_possible_neighbors
+        tmp_count = np.count_nonzero(tmp)
+        # Tell the propagator to update the neighbor's own neighbors if a change has been made
+        if self.possibilities_count[neighbor] != tmp_count:
+            self.stats.propagation_removed_modules += int(self.possibilities_count[neighbor] - tmp_count)
+            self.update_cell(neighbor, tmp)
+            return True
+        return False
+
+    def get_minimal_entropy_cell(self):
+        """ Returns the cell with the lowest entropy of all, if multiple cells
+        have the same entropy, choose one at random """
+        while self.entropy_heap:
+            entropy, _, cell = heapq.heappop(self.entropy_heap)
+            # Entries are never removed when a cell changes, a new one is pushed
+            # instead: skip the outdated ones and the already finished cells
+            if self.possibilities_count[cell] > 1 and entropy == self.get_entropy(cell):
+                return cell
+        return None
+
+    def get_entropy(self, cell):
+        """ Shannon entropy of the cell's possible modules, given their weights """
+        sum_weights = self.sum_weights[cell]
+        return round(math.log(sum_weights) - self.sum_weight_log_weights[cell] / sum_weights, ENTROPY_DECIMALS)
+
+    def push_entropy(self, cell):
+        """ Schedules the cell with its current entropy, the random tie-break
+        makes cells with the same entropy come out in a random (but seeded) order """
+        heapq.heappush(self.entropy_heap, (
+            self.get_entropy(cell), self.random.random(), cell
+        ))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solve a map without Blender")
+    parser.add_argument("modules", help="modules json, e.g. win_tubes.json")
+    parser.add_argument("--size", type=int, nargs=3, default=[10, 10, 10], metavar=("X", "Y", "Z"))
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--backtracking", action="store_true", help="undo contradictions instead of leaving impossible cells")
+    parser.add_argument("--output", help="save the solved grid of module indices to this .npy file, see save_map")
+    parser.add_argument("--trace", help="write a binary trace of the solve to this file, see read_trace")
+    args = parser.parse_args()
+
+    ruleset = Ruleset.from_json(args.modules)
+    trace = Trace(args.trace) if args.trace else None
+    solver = Solver(ruleset, args.size, args.seed, backtracking=args.backtracking, trace=trace)
+    grid = solver.solve()
+    if trace is not None:
+        trace.close()
+    print(f"{len(ruleset)} modules, {ruleset.socket_types_count + 1} socket types")
+    print(solver.stats)
+    print(f"{solver.get_impossible_positions_count()}/{grid.size} impossible positions")
+    if args.output:
+        save_map(args.output, grid, ruleset)